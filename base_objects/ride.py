@@ -17,6 +17,17 @@ class Profitability:
     profit: float or None
 
 
+@dataclass
+class ArchivedRide:
+    """
+    Finished ride reduced to what the post-hoc analysis needs
+    """
+    events: list
+    profitability: Profitability
+    ride_type: str
+    active: bool = False
+
+
 class Ride:
     """
     Basic object to rides
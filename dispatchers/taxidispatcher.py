@@ -6,17 +6,57 @@ import logging
 from typing import Any
 from datetime import datetime as dt
 
+import copy
+import heapq
+import dataclasses
+from collections import Counter
+from concurrent.futures import ProcessPoolExecutor
+from itertools import count, combinations
+
 import numpy as np
 
 import utils.common as utc
 import utils.pool_tools
+import utils.shareability
+from utils import assignment_tools, skim_tools
+from utils.profiling import Profiler
 
 from base_objects.vehicle import Vehicle
 from base_objects.traveller import Traveller
 from base_objects.dispatcher import Dispatcher
+from base_objects.ride import ArchivedRide
 
 from rides.taxi_ride import TaxiRide
 from rides.pool_ride import PoolRide
+from utils.spatial_index import VehicleGridIndex
+
+
+# Skim attached by worker processes evaluating pool rides
+_WORKER_SKIM = None
+
+# Records nothing, for calls without a profiler
+_NO_PROFILING = Profiler()
+
+
+def _initialise_pool_worker(skim_handle: dict) -> None:
+    global _WORKER_SKIM
+    _WORKER_SKIM = skim_tools.attach_skim(skim_handle)
+
+
+def _evaluate_pool_rides_in_worker(args: tuple) -> (list, Profiler):
+    """ Evaluate a chunk of rides, shared utilities keyed by traveller id """
+    rides, traveller, new_locations, maximal_pickup, fares, operating_costs, kwargs = args
+    kwargs["profiler"] = Profiler(kwargs.pop("profiling"))
+    out = []
+    for ride in rides:
+        ride_assignments = TaxiDispatcher.evaluate_pool_ride(
+            ride, traveller, new_locations, maximal_pickup, fares, operating_costs, _WORKER_SKIM, **kwargs
+        )
+        out.append([(comb, profitability,
+                     {pax.traveller_id: utility for pax, utility in shared_utility.items()},
+                     adm_combs)
+                    for comb, profitability, shared_utility, adm_combs in ride_assignments])
+    return out, kwargs["profiler"]
 
 
 class TaxiDispatcher(Dispatcher):
@@ -28,11 +68,230 @@ class TaxiDispatcher(Dispatcher):
                  dispatcher_id: float or str,
                  fares: dict,
                  operating_costs: dict,
-                 fleet: dict or None = None
+                 fleet: dict or None = None,
+                 skim: dict or None = None,
+                 path_cache: skim_tools.PathCache or None = None,
+                 profiler: Profiler or None = None
                  ):
+        """
+        @param skim: if given, available vehicles are kept in a spatial index
+         for 'ch' skims, whose distances are queried pair by pair, and their positions
+         in arrays for vectorised queries of rows of 'graph' and 'dijkstra' skims
+        @param path_cache: legs of vehicle routes, may be shared between dispatchers
+        @param profiler: records timings of dispatching stages, disabled if not given
+        """
         super().__init__(dispatcher_id, fares, operating_costs, fleet)
         self.fleet = {k: [] for k in np.unique(fleet['type'])} if fleet is not None else None
-        self.rides = {k: [] for k in np.unique(fleet['type'])} if fleet is not None else None
+        # Active rides by type, finished ones are moved to the archive
+        self.rides = {k: {} for k in np.unique(fleet['type'])} if fleet is not None else None
+        self.ride_archive = {}
+        self._ride_numbers = {}
+        self._ride_counter = count()
+        self.pending_requests = []
+        self.rejected_rides = Counter()
+        self.executor = None
+        self.pool_workers = 1
+        self.path_cache = path_cache if path_cache is not None else skim_tools.PathCache()
+        self.profiler = profiler if profiler is not None else Profiler()
+        self.vehicle_index = {k: VehicleGridIndex(skim) for k in self.fleet.keys()} \
+            if skim is not None and skim["type"] == "ch" and self.fleet is not None else None
+        self.max_speed = 0
+        self._fleet_order = {}
+
+        # Live sets kept in step with the vehicles' state
+        self.available_vehicles = {k: {} for k in self.fleet.keys()} if self.fleet is not None else None
+        self.empty_pool_vehicles = {}
+        self._shift_ends = []
+        self._expired = {}
+        self._revived = {}
+
+        # Vehicles in order of registration with their state as arrays
+        self._node_index = skim["node_index"] \
+            if skim is not None and skim["type"] in ("graph", "dijkstra") else None
+        self._type_codes = {k: num for num, k in enumerate(self.fleet.keys())} \
+            if self.fleet is not None else {}
+        self._vehicles = []
+        self._fleet_nodes = np.zeros(16, dtype=np.int64)
+        self._fleet_speeds = np.ones(16, dtype=np.float64)
+        self._fleet_types = np.zeros(16, dtype=np.int64)
+        self._fleet_available = np.zeros(16, dtype=bool)
+        self._fleet_empty = np.zeros(16, dtype=bool)
+
+    def add_vehicle(self,
+                    vehicle: Vehicle,
+                    veh_type: str
+                    ) -> None:
+        """
+        Register a new vehicle in the fleet
+        @param vehicle: Vehicle object
+        @param veh_type: pool, taxi etc.
+        """
+        self._fleet_order[vehicle] = (veh_type, len(self.fleet[veh_type]), len(self._vehicles))
+        self.fleet[veh_type].append(vehicle)
+        self.max_speed = max(self.max_speed, vehicle.vehicle_speed)
+
+        num = len(self._vehicles)
+        self._vehicles.append(vehicle)
+        if num == len(self._fleet_nodes):
+            for name in ('_fleet_nodes', '_fleet_speeds', '_fleet_types',
+                         '_fleet_available', '_fleet_empty'):
+                array = getattr(self, name)
+                setattr(self, name, np.concatenate([array, np.zeros_like(array)]))
+        self._fleet_speeds[num] = vehicle.vehicle_speed
+        self._fleet_types[num] = self._type_codes[veh_type]
+        heapq.heappush(self._shift_ends, (vehicle.path.end_time, num, vehicle))
+        self.update_vehicle(vehicle)
+
+    def update_vehicle(self,
+                       vehicle: Vehicle
+                       ) -> None:
+        """
+        Synchronise indexes with the vehicle's position, availability
+        and occupancy. To be called whenever any of them changes
+        @param vehicle: Vehicle object
+        """
+        if vehicle not in self._fleet_order:
+            return
+        veh_type, _, num = self._fleet_order[vehicle]
+        empty = len(vehicle.scheduled_travellers) + len(vehicle.travellers) == 0
+
+        if vehicle.available:
+            self.available_vehicles[veh_type][vehicle] = None
+            if vehicle in self._expired:
+                self._revived[vehicle] = None
+        else:
+            self.available_vehicles[veh_type].pop(vehicle, None)
+        if veh_type == 'pool' and empty:
+            self.empty_pool_vehicles[vehicle] = None
+        else:
+            self.empty_pool_vehicles.pop(vehicle, None)
+
+        if self.vehicle_index is not None:
+            index = self.vehicle_index[veh_type]
+            if vehicle.available:
+                index.add(vehicle)
+            else:
+                index.remove(vehicle)
+
+        if self._node_index is None:
+            return
+        self._fleet_nodes[num] = self._node_index[vehicle.path.current_position]
+        self._fleet_available[num] = vehicle.available
+        self._fleet_empty[num] = empty
+
+    def expire_vehicles(self,
+                        current_time: dt
+                        ) -> None:
+        """
+        Withdraw vehicles whose shift ended by the given time,
+        also those which became available again after their shift
+        @param current_time: simulation time
+        """
+        while self._shift_ends and self._shift_ends[0][0] <= current_time:
+            _, _, vehicle = heapq.heappop(self._shift_ends)
+            self._expired[vehicle] = None
+            self._revived[vehicle] = None
+
+        revived, self._revived = self._revived, {}
+        for vehicle in revived:
+            vehicle.available = False
+            self.update_vehicle(vehicle)
+
+    def archive_ride(self,
+                     ride: TaxiRide or PoolRide
+                     ) -> None:
+        """
+        Move a finished ride out of the active rides
+        @param ride: ride which is no longer active
+        """
+        ride_type, num = self._ride_numbers.pop(ride)
+        del self.rides[ride_type][ride]
+        self.ride_archive.setdefault(ride_type, []).append((num, ArchivedRide(
+            events=ride.events,
+            profitability=ride.profitability,
+            ride_type=ride.ride_type
+        )))
+
+    def all_rides(self) -> list:
+        """
+        Active and archived rides, by type and in order of assignment
+        @return: list of rides
+        """
+        out = []
+        for ride_type, rides in self.rides.items():
+            numbered = [(self._ride_numbers[ride][1], ride) for ride in rides]
+            numbered += self.ride_archive.get(ride_type, [])
+            out += [ride for _, ride in sorted(numbered, key=lambda x: x[0])]
+        return out
+
+    def _vehicles_by_bound(self,
+                           node: int,
+                           veh_types: list,
+                           skim: dict
+                           ) -> (list, float):
+        """
+        Available vehicles ordered by the lower bound of the distance to the node
+        @param node: city node
+        @param veh_types: pool, taxi etc.
+        @param skim: skim matrix
+        @return: iterable of (bound, (type order, fleet order), vehicle), maximal speed
+        """
+        if self.vehicle_index is not None:
+            streams = [
+                ((bound, (type_order, self._fleet_order[veh][1]), veh) for bound, veh in
+                 self.vehicle_index[veh_type].iter_nearest(node))
+                for type_order, veh_type in enumerate(veh_types)
+            ]
+            return heapq.merge(*streams, key=lambda x: x[:2]), self.max_speed
+
+        candidates = [((type_order, self._fleet_order[veh][1]), veh)
+                      for type_order, veh_type in enumerate(veh_types)
+                      for veh in self.available_vehicles[veh_type]]
+        if not candidates:
+            return [], 0
+        bounds = utc.distance_lower_bound(
+            node, [veh.path.current_position for _, veh in candidates], skim
+        )
+        return sorted(((bound, order, veh) for bound, (order, veh) in zip(bounds, candidates)),
+                      key=lambda x: x[:2]), max(veh.vehicle_speed for _, veh in candidates)
+
+    def _closest_vehicle_vectorised(self,
+                                   node: int,
+                                   veh_types: list,
+                                   skim: dict,
+                                   pool_flag: bool
+                                   ) -> (float, Vehicle) or None:
+        """
+        Pickup times of the whole fleet from a single gather on the skim row
+        of the node, vehicles filtered with boolean masks
+        @param node: city node
+        @param veh_types: pool, taxi etc.
+        @param skim: skim matrix
+        @param pool_flag: only pool vehicles without travellers
+        @return (time to arrival, Vehicle) or None (not found)
+        """
+        size = len(self._vehicles)
+        if size == 0:
+            return None
+        available = self._fleet_available[:size]
+        times = utc.skim_lookup(self._node_index[node], self._fleet_nodes[:size], skim)
+        times /= self._fleet_speeds[:size]
+
+        time_base = (1e6, None)
+        for veh_type in veh_types:
+            mask = available & (self._fleet_types[:size] == self._type_codes[veh_type])
+            if veh_type == 'pool' and pool_flag:
+                mask &= self._fleet_empty[:size]
+            if not mask.any():
+                continue
+            candidates = np.flatnonzero(mask)
+            num = candidates[np.argmin(times[candidates])]
+            if time_base[0] > times[num]:
+                time_base = (float(times[num]), self._vehicles[num])
+
+        if time_base[1] is None:
+            return None
+        return time_base
 
     def find_closest_vehicle(self,
                              request: tuple,
@@ -45,23 +304,44 @@ class TaxiDispatcher(Dispatcher):
         @param request: (node, event, traveller)
         @param veh_types: pool, taxi etc.
         @param skim: skim matrix
+        @param kwargs: empty_pool - only pool vehicles without travellers,
+         maximal_pickup - skip vehicles surely further (in time) than that
         @return (time to arrival, Vehicle) or None (not found)
         """
+        with self.profiler.timer("nearest_vehicle"):
+            return self._find_closest_vehicle(request, veh_types, skim, **kwargs)
+
+    def _find_closest_vehicle(self,
+                              request: tuple,
+                              veh_types: list,
+                              skim: dict,
+                              **kwargs
+                              ) -> Vehicle or None:
         node = request[1]
         time_base = (1e6, None)
+        best_order = (-1,)
         pool_flag = kwargs.get('empty_pool', False)
+        maximal_pickup = kwargs.get('maximal_pickup', np.inf)
 
-        # Find fitting fleet
-        for veh_type in veh_types:
-            for veh in self.fleet[veh_type]:
-                if veh_type == 'pool' and pool_flag:
-                    if len(veh.scheduled_travellers) + len(veh.travellers) != 0:
-                        continue
-                if veh.available:
-                    time_new = utc.compute_distance([node, veh.path.current_position], skim)
-                    time_new /= veh.vehicle_speed
-                    if time_base[0] > time_new:
-                        time_base = (time_new, veh)
+        # Skim rows are cheap to gather: all pickup times at once
+        if self._node_index is not None and skim["type"] in ("graph", "dijkstra"):
+            return self._closest_vehicle_vectorised(node, veh_types, skim, pool_flag)
+
+        # Visit vehicles by the lower bound of the pickup distance,
+        # stop once no remaining vehicle can be closer than the best one
+        candidates, max_speed = self._vehicles_by_bound(node, veh_types, skim)
+        for bound, order, veh in candidates:
+            if bound / max_speed > min(time_base[0], maximal_pickup):
+                break
+            if veh_types[order[0]] == 'pool' and pool_flag and veh not in self.empty_pool_vehicles:
+                continue
+            if bound / veh.vehicle_speed > min(time_base[0], maximal_pickup):
+                continue
+            time_new = utc.compute_distance([node, veh.path.current_position], skim)
+            time_new /= veh.vehicle_speed
+            if (time_new, order) < (time_base[0], best_order):
+                time_base = (time_new, veh)
+                best_order = order
 
         if time_base[1] is None:
             return None
@@ -149,17 +429,22 @@ class TaxiDispatcher(Dispatcher):
         taxi_ride.profitability.profit = profitability[2]
         vehicle.available = False
         vehicle.scheduled_travellers = [traveller]
+        started = self.profiler.start()
         vehicle.path.current_path = utc.compute_path(
             [vehicle.path.current_position] + [t[0] for t in taxi_ride.destination_points],
-            skim
+            skim,
+            self.path_cache
         )
+        self.profiler.stop("rerouting", started)
         vehicle.path.closest_crossroad = vehicle.path.current_path[1]
         vehicle.path.stationary_position = False
+        self.update_vehicle(vehicle)
 
         if taxi_or_pool not in self.rides.keys():
-            self.rides[taxi_or_pool] = [taxi_ride]
+            self.rides[taxi_or_pool] = {taxi_ride: None}
         else:
-            self.rides[taxi_or_pool].append(taxi_ride)
+            self.rides[taxi_or_pool][taxi_ride] = None
+        self._ride_numbers[taxi_ride] = (taxi_or_pool, next(self._ride_counter))
 
         traveller.utilities['taxi'] = utility
 
@@ -174,48 +459,41 @@ class TaxiDispatcher(Dispatcher):
                           f"{vehicle.path.current_time}: Traveller"
                           f" {traveller} assigned to vehicle {vehicle}")
 
-    def pool_utility(self,
-                     request: tuple,
-                     traveller: Traveller,
-                     skim: dict,
-                     **kwargs
-                     ) -> (list, dict or None):
+    def private_ride_offer(self,
+                           request: tuple,
+                           traveller: Traveller,
+                           closest_vehicle: tuple or None,
+                           skim: dict
+                           ) -> dict or None:
         """
-        Calculate utility of a pool ride
+        Private (non-shared) pool ride with the given vehicle,
+        sets traveller's utility of the private ride
         @param request: (traveller_id, origin, destination, request_time)
         @param traveller: Traveller object
+        @param closest_vehicle: (time to arrival, Vehicle) or None
         @param skim: skim dictionary
-        @param kwargs: additional settings to choose pooling options
-        @return:
+        @return: details required by assign_taxi or None if infeasible
         """
         new_locations = [(request[1], 'o', request[0]), (request[2], 'd', request[0])]
 
         maximal_pick_up = traveller.behavioural_details["maximal_pickup"]
 
-        # Consider baseline taxi
         pax_cond = traveller.utilities.get('taxi') is None or False
         baseline_taxi = PoolRide(
             traveller=traveller,
             destination_points=new_locations,
             ride_type='pool'
         )
-        closest_vehicle = self.find_closest_vehicle(
-            request=request,
-            veh_types=['pool'],
-            skim=skim,
-            empty_pool=True
-        )
 
         if closest_vehicle is None:
             taxi_feasible = False
-        else:
-            taxi_feasible = True
-
-        if utils.common.compute_distance(
+        elif utils.common.compute_distance(
                 [closest_vehicle[1].path.current_position, request[1]],
                 skim
         ) / closest_vehicle[1].vehicle_speed > maximal_pick_up:
             taxi_feasible = False
+        else:
+            taxi_feasible = True
 
         if taxi_feasible and pax_cond:
             traveller.utilities['taxi'] = TaxiRide.calculate_utility(
@@ -229,123 +507,581 @@ class TaxiDispatcher(Dispatcher):
         else:
             traveller.utilities['taxi'] = False
 
-        if taxi_feasible:
-            taxi_out = {'taxi_ride': baseline_taxi,
-                        'vehicle': closest_vehicle[1],
-                        'pickup_delay': closest_vehicle[0],
-                        'utility': traveller.utilities['taxi'],
-                        'traveller': traveller,
-                        'profitability': baseline_taxi.calculate_profitability(
-                            fare=self.fares["pool"],
-                            operating_cost=self.operating_costs["pool"],
-                            skim=skim
-                        )}
-        else:
-            taxi_out = None
+        if not taxi_feasible:
+            return None
 
-        # Search through ongoing pool rides
-        possible_assignments = []
+        return {'taxi_ride': baseline_taxi,
+                'vehicle': closest_vehicle[1],
+                'pickup_delay': closest_vehicle[0],
+                'utility': traveller.utilities['taxi'],
+                'traveller': traveller,
+                'profitability': baseline_taxi.calculate_profitability(
+                    fare=self.fares["pool"],
+                    operating_cost=self.operating_costs["pool"],
+                    skim=skim
+                )}
 
-        for ride in self.rides["pool"]:
-            # look only for actual pool rides
-            if len(ride.travellers) == 0:
-                continue
+    def _pickup_times(self,
+                      requests: list,
+                      travellers: list,
+                      skim: dict
+                      ) -> (list, np.ndarray, np.ndarray):
+        """
+        Pickup times of available empty pool vehicles for requests
+        @param requests: list of (traveller_id, origin, destination, request_time)
+        @param travellers: Traveller objects corresponding to the requests
+        @param skim: skim dictionary
+        @return: vehicles in fleet order, request x vehicle pickup times
+         and mask of pickups within travellers' maximal pickup
+        """
+        started = self.profiler.start()
+        vehicles = sorted((veh for veh in self.empty_pool_vehicles if veh.available),
+                          key=lambda veh: self._fleet_order[veh][2])
+        if not requests or not vehicles:
+            return vehicles, np.zeros((len(requests), len(vehicles))), \
+                np.zeros((len(requests), len(vehicles)), dtype=bool)
 
-            max_distance_pickup = maximal_pick_up / ride.serving_vehicle.vehicle_speed
+        # Vehicles' positions to requests' origins
+        origins = np.array([skim["node_index"][request[1]] for request in requests], dtype=np.int64)
+        positions = np.array([skim["node_index"][veh.path.current_position] for veh in vehicles],
+                             dtype=np.int64)
+        distances = utc.skim_lookup(positions[None, :], origins[:, None], skim)
+        pickup_times = distances / np.array([veh.vehicle_speed for veh in vehicles], dtype=float)
+        maximal_pickups = np.array([pax.behavioural_details["maximal_pickup"] for pax in travellers],
+                                   dtype=float)
+        self.profiler.stop("pickup_times", started)
+        return vehicles, pickup_times, pickup_times <= maximal_pickups[:, None]
 
-            # Filter 1: combinations must save kilometres
-            destination_points = [ride.serving_vehicle.path.closest_crossroad]\
-                                 + [t[0] for t in ride.destination_points]
-            max_trip_length = utc.compute_distance(destination_points, skim)
-            max_trip_length += utc.compute_distance(
-                [t[0] for t in new_locations],
-                skim)
-            # destination_points += new_locations
+    def batch_taxi_assignment(self,
+                              requests: list,
+                              travellers: list,
+                              skim: dict,
+                              **kwargs
+                              ) -> list:
+        """
+        Jointly assign empty pool vehicles to requests collected over a time window,
+        minimising the total pickup time
+        @param requests: list of (traveller_id, origin, destination, request_time)
+        @param travellers: Traveller objects corresponding to the requests
+        @param skim: skim dictionary
+        @return: for each request details required by assign_taxi or None if not served
+        """
+        offers = [None] * len(requests)
+        vehicles, pickup_times, feasible = self._pickup_times(requests, travellers, skim)
+        if not requests or not vehicles:
+            return offers
 
-            od_combinations = utils.pool_tools.admissible_future_combinations(
-                new_locations=new_locations,
-                ride=ride,
-                max_trip_length=max_trip_length,
-                max_distance_pickup=max_distance_pickup,
-                skim=skim,
-                execution_time=True
+        for row, col in assignment_tools.solve_assignment(pickup_times, feasible):
+            offers[row] = self.private_ride_offer(
+                requests[row], travellers[row], (float(pickup_times[row, col]), vehicles[col]), skim
             )
 
-            # If it's not feasible to associate the new request
-            if not od_combinations:
-                continue
+        utc.log_if_logger(kwargs.get("logger"), 20,
+                          f"Batch of {len(requests)} requests, {len(vehicles)} vehicles:"
+                          f" {sum(offer is not None for offer in offers)} assigned")
+        return offers
+
+    def batch_pool_assignment(self,
+                              requests: list,
+                              travellers: list,
+                              skim: dict,
+                              **kwargs
+                              ) -> list:
+        """
+        Pool requests collected over a time window into shared rides.
+        Requests which save kilometres when served together form the shareability graph,
+        its cliques up to max_trip_size are trips. A trip is feasible if it is
+        no less profitable than any of its subtrips with one traveller fewer
+        (as adding a traveller to an ongoing ride) and with a vehicle if it is
+        more attractive than the private ride for each traveller. Trips are chosen greedily, largest
+        and most profitable first, and assigned to vehicles
+        @param requests: list of (traveller_id, origin, destination, request_time)
+        @param travellers: Traveller objects corresponding to the requests
+        @param skim: skim dictionary
+        @param kwargs: max_trip_size - maximal number of travellers in a trip,
+         vehicles_per_trip - number of closest vehicles considered for a trip
+        @return: for each request whether it was assigned
+        """
+        max_trip_size = kwargs.get("max_trip_size", 3)
+        vehicles_per_trip = kwargs.get("vehicles_per_trip", 5)
+        assigned = [False] * len(requests)
+        vehicles, pickup_times, feasible = self._pickup_times(requests, travellers, skim)
 
-            output_pool = {tuple(comb): {} for comb in od_combinations}
-            adm_combs = od_combinations.copy()
-
-            # Filter 2: utility for travellers
-            if kwargs.get("attractive_only", True):
-                for comb in od_combinations.copy():
-                    paxes = ride.travellers + [traveller]
-                    shared_utility = {pax: ride.calculate_utility(
-                        vehicle=ride.serving_vehicle,
-                        traveller=pax,
-                        nodes_seq=comb,
-                        no_travellers=len(paxes),
+        # Only requests which could be served by a private ride are considered
+        candidates = [num for num in range(len(requests)) if feasible[num].any()]
+        if len(candidates) < 2:
+            return assigned
+        locations = [[(requests[num][1], 'o', requests[num][0]), (requests[num][2], 'd', requests[num][0])]
+                     for num in candidates]
+        trip_lengths = [travellers[num].request_details.trip_length for num in candidates]
+
+        # Reference private ride: the closest vehicle
+        taxi_utility = {}
+        private_profit = {}
+        for num in candidates:
+            best = int(np.argmin(np.where(feasible[num], pickup_times[num], np.inf)))
+            taxi_utility[num] = TaxiRide.calculate_utility(
+                vehicle=vehicles[best],
+                pickup_delay=float(pickup_times[num, best]),
+                traveller=travellers[num],
+                fare=self.fares["taxi"],
+                skim=skim
+            )
+            private_profit[num] = PoolRide(
+                traveller=travellers[num],
+                destination_points=locations[candidates.index(num)],
+                ride_type='pool'
+            ).calculate_profitability(
+                fare=self.fares["pool"],
+                operating_cost=self.operating_costs["pool"],
+                skim=skim
+            )[2]
+
+        def evaluate(trip, trips):
+            """ Profitable sequences serving the trip, from the most profitable """
+            members = [candidates[k] for k in trip]
+            if len(trip) == 2:
+                base_profit = max(private_profit[num] for num in members)
+            else:
+                base_profit = max(trips[sub][0][1][2] for sub in combinations(trip, len(trip) - 1))
+            ride = PoolRide(traveller=travellers[members[0]], destination_points=[], ride_type='pool')
+            ride.travellers = [travellers[num] for num in members[:-1]]
+            out = []
+            for sequence, _ in utils.shareability.shared_sequences(
+                    [locations[k] for k in trip], [trip_lengths[k] for k in trip], skim):
+                profitability = ride.calculate_profitability(
+                    fare=self.fares["pool"],
+                    operating_cost=self.operating_costs["pool"],
+                    skim=skim,
+                    new_ods=sequence,
+                    additional_traveller=travellers[members[-1]],
+                    sharing_discount=self.fares["pool_discount"]
+                )
+                if profitability[2] >= base_profit:
+                    out.append((sequence, profitability))
+            return sorted(out, key=lambda x: -x[1][2]) or None
+
+        edges = utils.shareability.shareability_graph(locations, trip_lengths, skim)
+        trips = utils.shareability.enumerate_trips(edges, max_trip_size, evaluate)
+
+        # Trip-vehicle pairs with the sequence attractive for all travellers
+        traveller_position = {travellers[num].traveller_id: num for num in candidates}
+        options = []
+        for trip, sequences in trips.items():
+            members = [candidates[k] for k in trip]
+            closest = np.argsort(pickup_times[members].min(axis=0), kind='stable')[:vehicles_per_trip]
+            ride = PoolRide(traveller=travellers[members[0]], destination_points=[], ride_type='pool')
+            ride.travellers = [travellers[num] for num in members[:-1]]
+            # Distance along each sequence from the first origin to the origin of each traveller
+            to_origins = []
+            for sequence, _ in sequences:
+                nodes = np.array([skim["node_index"][t[0]] for t in sequence], dtype=np.int64)
+                along = np.concatenate(([0.0], np.cumsum(utc.skim_lookup(nodes[:-1], nodes[1:], skim))))
+                to_origins.append({traveller_position[t[2]]: float(along[pos])
+                                   for pos, t in enumerate(sequence) if t[1] == 'o'})
+            for col in closest.tolist():
+                vehicle = vehicles[col]
+                if vehicle.maximal_occupancy < len(members):
+                    continue
+                at_rest = copy.copy(vehicle)
+                at_rest.path = dataclasses.replace(vehicle.path,
+                                                   closest_crossroad=vehicle.path.current_position,
+                                                   to_closest_crossroads=0)
+                for (sequence, profitability), to_origin in zip(sequences, to_origins):
+                    first = traveller_position[sequence[0][2]]
+                    # Each traveller picked up within the maximal pickup, also after a detour
+                    if any(pickup_times[first, col] + to_origin[num] / vehicle.vehicle_speed
+                           > travellers[num].behavioural_details["maximal_pickup"] for num in members):
+                        continue
+                    shared_utility = {num: ride.calculate_utility(
+                        vehicle=at_rest,
+                        traveller=travellers[num],
+                        nodes_seq=sequence,
                         fare=self.fares['pool'],
                         pool_discount=self.fares['pool_discount'],
                         skim=skim
-                    ) for pax in paxes}
-                    if not all([shared_utility[key] > key.utilities['taxi'] for key in shared_utility.keys()]):
-                        od_combinations.remove(comb)
-                        del output_pool[tuple(comb)]
-                    else:
-                        output_pool[tuple(comb)]['shared_utility'] = shared_utility
-
-            # If it's not feasible to assign the new request
-            if not od_combinations:
+                    ) for num in members}
+                    if all(shared_utility[num] > taxi_utility[num] for num in members):
+                        options.append((-len(members), -profitability[2], float(pickup_times[first, col]),
+                                        col, trip, sequence, profitability, shared_utility))
+                        break
+
+        used_vehicles = set()
+        for _, _, pickup_delay, col, trip, sequence, profitability, shared_utility in \
+                sorted(options, key=lambda x: x[:5]):
+            members = [candidates[k] for k in trip]
+            if col in used_vehicles or any(assigned[num] for num in members):
                 continue
+            used_vehicles.add(col)
+            for num in members:
+                assigned[num] = True
+            self._assign_shared_trip(
+                [travellers[traveller_position[t[2]]] for t in sequence if t[1] == 'o'],
+                vehicles[col], sequence, pickup_delay,
+                {travellers[num]: taxi_utility[num] for num in members},
+                {travellers[num]: shared_utility[num] for num in members},
+                skim, logger=kwargs.get("logger")
+            )
+
+        utc.log_if_logger(kwargs.get("logger"), 20,
+                          f"Batch of {len(requests)} requests: {len(trips)} shareable trips,"
+                          f" {sum(assigned)} travellers pooled")
+        return assigned
+
+    def _assign_shared_trip(self,
+                            travellers: list,
+                            vehicle: Vehicle,
+                            sequence: list,
+                            pickup_delay: float,
+                            taxi_utility: dict,
+                            shared_utility: dict,
+                            skim: dict,
+                            **kwargs
+                            ) -> None:
+        """
+        Assign a vehicle to travellers sharing a ride
+        @param travellers: Traveller objects in the order of pick-up
+        @param vehicle: Vehicle to serve the ride
+        @param sequence: (node, event, traveller) to be visited along the route
+        @param pickup_delay: time to arrival at the first traveller
+        @param taxi_utility: traveller -> utility of the private ride
+        @param shared_utility: traveller -> utility of the shared ride
+        @param skim: skim dictionary
+        """
+        first = travellers[0]
+        first_points = [t for t in sequence if t[2] == first.traveller_id]
+        # The vehicle has not moved yet, it is routed along the whole sequence once
+        ride = PoolRide(
+            traveller=first,
+            destination_points=list(sequence),
+            ride_type='pool'
+        )
+        self.assign_taxi(
+            taxi_ride=ride,
+            vehicle=vehicle,
+            utility=taxi_utility[first],
+            traveller=first,
+            profitability=ride.calculate_profitability(
+                fare=self.fares["pool"],
+                operating_cost=self.operating_costs["pool"],
+                skim=skim,
+                new_ods=first_points
+            ),
+            skim=skim,
+            pickup_delay=pickup_delay,
+            logger=kwargs.get("logger")
+        )
+
+        for traveller in travellers[1:]:
+            traveller.utilities['taxi'] = taxi_utility[traveller]
+            ride.events.append((vehicle.path.current_time, vehicle.path.current_position,
+                                'a', traveller.traveller_id))
+            ride.add_traveller(
+                traveller=traveller,
+                new_profitability=ride.calculate_profitability(
+                    fare=self.fares["pool"],
+                    operating_cost=self.operating_costs["pool"],
+                    skim=skim,
+                    new_ods=sequence,
+                    additional_traveller=traveller,
+                    sharing_discount=self.fares["pool_discount"]
+                ),
+                ods_sequence=list(sequence),
+                adm_combinations=[list(sequence)],
+                skim=skim,
+                reroute=False
+            )
+
+        for traveller in travellers:
+            traveller.utilities['pool'] = shared_utility[traveller]
+
+    @staticmethod
+    def evaluate_pool_ride(ride: PoolRide,
+                           traveller: Traveller,
+                           new_locations: list,
+                           maximal_pickup: float,
+                           fares: dict,
+                           operating_costs: dict,
+                           skim: dict,
+                           **kwargs
+                           ) -> list:
+        """
+        Admissible, attractive and profitable insertions of the new traveller into the ride
+        @param ride: ongoing pool ride
+        @param traveller: Traveller object
+        @param new_locations: [(node, 'o', traveller), (node, 'd', traveller)]
+        @param maximal_pickup: traveller's maximal pickup
+        @param fares: fares of the operator
+        @param operating_costs: operating costs of the operator
+        @param skim: skim dictionary
+        @param kwargs: attractive_only, profitable_only - filters as in pool_utility,
+         profiler - records the stages and counts of combinations
+        @return: list of (combination, profitability, shared utility, admissible combinations)
+        """
+        profiler = kwargs.get("profiler") or _NO_PROFILING
+        profiler.count("rides_evaluated")
+        started = profiler.start()
+        max_distance_pickup = maximal_pickup / ride.serving_vehicle.vehicle_speed
+
+        # Filter 1: combinations must save kilometres
+        destination_points = [ride.serving_vehicle.path.closest_crossroad]\
+                             + [t[0] for t in ride.destination_points]
+        max_trip_length = utc.compute_distance(destination_points, skim)
+        max_trip_length += utc.compute_distance(
+            [t[0] for t in new_locations],
+            skim)
+        # destination_points += new_locations
+
+        od_combinations = utils.pool_tools.admissible_future_combinations(
+            new_locations=new_locations,
+            ride=ride,
+            max_trip_length=max_trip_length,
+            max_distance_pickup=max_distance_pickup,
+            skim=skim
+        )
+        profiler.stop("insertions", started)
+        profiler.count("combinations_admissible", len(od_combinations))
+
+        # If it's not feasible to associate the new request
+        if not od_combinations:
+            return []
+
+        output_pool = {tuple(comb): {} for comb in od_combinations}
+        adm_combs = od_combinations.copy()
+
+        # Filter 2: utility for travellers
+        if kwargs.get("attractive_only", True):
+            started = profiler.start()
+            paxes = ride.travellers + [traveller]
+            utilities = utils.pool_tools.score_utilities(
+                ride=ride,
+                travellers=paxes,
+                combinations=od_combinations,
+                fare=fares['pool'],
+                pool_discount=fares['pool_discount'],
+                skim=skim
+            )
+            for comb, comb_utilities in zip(od_combinations.copy(), utilities.tolist()):
+                shared_utility = dict(zip(paxes, comb_utilities))
+                if not all([shared_utility[key] > key.utilities['taxi'] for key in shared_utility.keys()]):
+                    od_combinations.remove(comb)
+                    del output_pool[tuple(comb)]
+                else:
+                    output_pool[tuple(comb)]['shared_utility'] = shared_utility
+            profiler.stop("utility_filter", started)
+            profiler.count("combinations_attractive", len(od_combinations))
+
+        # If it's not feasible to assign the new request
+        if not od_combinations:
+            return []
+
+        # Filter 3: calculate whether it's profitable for operator
+        base_profitability = ride.profitability.profit
+
+        if kwargs.get("profitable_only", True):
+            started = profiler.start()
+            profitability = utils.pool_tools.score_profitability(
+                ride=ride,
+                traveller=traveller,
+                combinations=od_combinations,
+                fare=fares["pool"],
+                operating_cost=operating_costs["pool"],
+                sharing_discount=fares["pool_discount"],
+                skim=skim
+            )
+            for comb, profitability_comb in zip(od_combinations.copy(), map(tuple, profitability.tolist())):
+                if profitability_comb[2] < base_profitability:
+                    od_combinations.remove(comb)
+                    del output_pool[tuple(comb)]
+                else:
+                    output_pool[tuple(comb)]['profitability'] = profitability_comb
+            profiler.stop("profitability_filter", started)
+            profiler.count("combinations_profitable", len(od_combinations))
 
-            # Filter 3: calculate whether it's profitable for operator
-            base_profitability = ride.profitability.profit
-
-            if kwargs.get("profitable_only", True):
-                for comb in od_combinations.copy():
-                    profitability_comb = ride.calculate_profitability(
-                        fare=self.fares["pool"],
-                        operating_cost=self.operating_costs["pool"],
-                        skim=skim,
-                        new_ods=comb,
-                        additional_traveller=traveller,
-                        sharing_discount=self.fares["pool_discount"],
-                        update_self=False
-                    )
-                    if profitability_comb[2] < base_profitability:
-                        od_combinations.remove(comb)
-                        del output_pool[tuple(comb)]
-                    else:
-                        output_pool[tuple(comb)]['profitability'] = profitability_comb
-
-            if not od_combinations:
+        if not od_combinations:
+            return []
+
+        return [(comb,
+                 output_pool[tuple(comb)]['profitability'],
+                 output_pool[tuple(comb)]['shared_utility'],
+                 adm_combs) for comb in od_combinations]
+
+    def _collect_pool_assignments(self,
+                                  rides: list,
+                                  traveller: Traveller,
+                                  new_locations: list,
+                                  maximal_pickup: float,
+                                  skim: dict,
+                                  candidates: utils.pool_tools.RankedCandidates,
+                                  **kwargs
+                                  ) -> int:
+        """
+        Evaluate candidate rides, in worker processes if these are started,
+        and offer their assignments to the candidates.
+        Evaluated in the process, a ride is skipped once no assignment
+        to it can be kept: profitable ones do not earn less than the ride alone
+        @return: number of rides skipped
+        """
+        skipped = 0
+        if self.executor is None or len(rides) < 2:
+            for ride in rides:
+                if kwargs.get("profitable_only", True) \
+                        and not candidates.admits(ride.profitability.profit):
+                    skipped += 1
+                    continue
+                for comb, profitability, shared_utility, adm_combs in self.evaluate_pool_ride(
+                        ride, traveller, new_locations, maximal_pickup,
+                        self.fares, self.operating_costs, skim, profiler=self.profiler, **kwargs):
+                    candidates.push(profitability[2],
+                                    (ride, comb, profitability, shared_utility, adm_combs))
+            return skipped
+
+        # Contiguous chunks, results come back in the order of rides
+        chunk_size = -(-len(rides) // self.pool_workers)
+        chunks = [rides[i:i + chunk_size] for i in range(0, len(rides), chunk_size)]
+        results = self.executor.map(
+            _evaluate_pool_rides_in_worker,
+            [(chunk, traveller, new_locations, maximal_pickup,
+              self.fares, self.operating_costs, dict(kwargs, profiling=self.profiler.enabled))
+             for chunk in chunks]
+        )
+        evaluations = []
+        for result, worker_profiler in results:
+            evaluations += result
+            self.profiler.merge(worker_profiler)
+
+        # Travellers were copied to workers, map them back by id
+        for ride, ride_assignments in zip(rides, evaluations):
+            paxes = {pax.traveller_id: pax for pax in ride.travellers + [traveller]}
+            for comb, profitability, shared_utility, adm_combs in ride_assignments:
+                candidates.push(profitability[2],
+                                (ride, comb, profitability,
+                                 {paxes[pax_id]: utility for pax_id, utility in shared_utility.items()},
+                                 adm_combs))
+        return skipped
+
+    def start_pool_workers(self,
+                           skim_handle: dict,
+                           workers: int
+                           ) -> None:
+        """
+        Start worker processes evaluating pool rides on the shared skim
+        @param skim_handle: returned by utils.skim_tools.share_skim
+        @param workers: number of processes
+        """
+        self.pool_workers = workers
+        self.executor = ProcessPoolExecutor(
+            max_workers=workers,
+            initializer=_initialise_pool_worker,
+            initargs=(skim_handle,)
+        )
+
+    def shutdown_pool_workers(self) -> None:
+        """ Stop worker processes, if started """
+        if self.executor is not None:
+            self.executor.shutdown()
+            self.executor = None
+
+    def pool_utility(self,
+                     request: tuple,
+                     traveller: Traveller,
+                     skim: dict,
+                     **kwargs
+                     ) -> (list, dict or None):
+        """
+        Calculate utility of a pool ride
+        @param request: (traveller_id, origin, destination, request_time)
+        @param traveller: Traveller object
+        @param skim: skim dictionary
+        @param kwargs: additional settings to choose pooling options,
+         max_candidates - number of pool assignments to return (default 1, None for all)
+        @return: pool assignments from the lowest profitability, private ride offer
+        """
+        started = self.profiler.start()
+        self.profiler.count("pool_requests")
+        new_locations = [(request[1], 'o', request[0]), (request[2], 'd', request[0])]
+
+        maximal_pick_up = traveller.behavioural_details["maximal_pickup"]
+
+        # Consider baseline taxi
+        closest_vehicle = self.find_closest_vehicle(
+            request=request,
+            veh_types=['pool'],
+            skim=skim,
+            empty_pool=True,
+            maximal_pickup=maximal_pick_up
+        )
+        taxi_out = self.private_ride_offer(request, traveller, closest_vehicle, skim)
+
+        # Search through ongoing pool rides
+        rejected = Counter()
+
+        # look only for actual pool rides with a free seat
+        rides = []
+        for ride in self.rides["pool"]:
+            if len(ride.travellers) == 0:
+                continue
+            vehicle = ride.serving_vehicle
+            if len(vehicle.scheduled_travellers) + len(vehicle.travellers) >= vehicle.maximal_occupancy:
+                rejected["capacity"] += 1
                 continue
+            rides.append(ride)
+
+        # Filter 0: the new origin beyond the pickup limit from the closest crossroad,
+        # by triangle inequality so it is when reached through any other node
+        max_distances_pickup = np.array([maximal_pick_up / ride.serving_vehicle.vehicle_speed
+                                         for ride in rides])
+        pickup_bounds = utc.distance_lower_bound(
+            [ride.serving_vehicle.path.closest_crossroad for ride in rides], request[1], skim
+        ) if rides else np.array([])
+        close = pickup_bounds <= max_distances_pickup
+        rejected["pickup_bound"] += int(np.sum(~close))
+        rides = [ride for ride, is_close in zip(rides, close) if is_close]
+        max_distances_pickup = max_distances_pickup[close]
+        pickups = utc.compute_distances_batch(
+            utc.route_indices([[ride.serving_vehicle.path.closest_crossroad, request[1]] for ride in rides],
+                              skim),
+            skim
+        ) if rides else np.array([])
+        close = pickups <= max_distances_pickup
+        rejected["pickup"] += int(np.sum(~close))
+        rides = [ride for ride, is_close in zip(rides, close) if is_close]
 
-            for comb in od_combinations:
-                possible_assignments.append((ride,
-                                             comb,
-                                             output_pool[tuple(comb)]['profitability'],
-                                             output_pool[tuple(comb)]['shared_utility'],
-                                             adm_combs))
+        candidates = utils.pool_tools.RankedCandidates(kwargs.get("max_candidates", 1))
+        rejected["profit_bound"] += self._collect_pool_assignments(
+            rides=rides,
+            traveller=traveller,
+            new_locations=new_locations,
+            maximal_pickup=maximal_pick_up,
+            skim=skim,
+            candidates=candidates,
+            attractive_only=kwargs.get("attractive_only", True),
+            profitable_only=kwargs.get("profitable_only", True)
+        )
+        self.rejected_rides.update(rejected)
+        possible_assignments = candidates.ranked()
 
         if possible_assignments:
             utc.log_if_logger(kwargs.get("logger"), 20,
                               f"Traveller {traveller}"
-                              f" found {len(possible_assignments)}"
+                              f" found {candidates.seen}"
                               f" admissible assignments")
         else:
             utc.log_if_logger(kwargs.get("logger"), 20,
                               f"Traveller {traveller}"
                               f" found NO admissible assignments. "
                               f"Feasible private ride: {taxi_out is not None}")
+        if rejected:
+            utc.log_if_logger(kwargs.get("logger"), 20,
+                              f"Traveller {traveller}: rides rejected before enumeration"
+                              f" {dict(rejected)}")
 
-        return sorted(possible_assignments, key=lambda x: x[2][2]), taxi_out
+        self.profiler.stop("pool_utility", started)
 
-    @staticmethod
-    def assign_pool(possible_assignments: list[
+        return possible_assignments, taxi_out
+
+    def assign_pool(self,
+                    possible_assignments: list[
         PoolRide,
         tuple or list,
         tuple or list,
@@ -362,13 +1098,17 @@ class TaxiDispatcher(Dispatcher):
         for _traveller in best_ride.travellers:
             _traveller.utilities["pool"] = utility[_traveller]
 
+        started = self.profiler.start()
         best_ride.add_traveller(
             traveller=traveller,
             new_profitability=profitability,
             ods_sequence=comb,
             adm_combinations=adm_combs,
-            skim=skim
+            skim=skim,
+            path_cache=self.path_cache
         )
+        self.profiler.stop("rerouting", started)
+        self.update_vehicle(best_ride.serving_vehicle)
 
         utc.log_if_logger(kwargs.get("logger"), 20,
                           f"{best_ride.serving_vehicle.path.current_time} No ongoing pool rides"
@@ -0,0 +1,40 @@
+"""
+Script to precompute the skim matrix of a city in parallel.
+Interrupted runs resume from the blocks already written to disk
+"""
+import os
+import argparse
+
+import utils.common as utc
+from utils.skim_tools import precompute_skim
+
+
+if __name__ == "__main__":
+    os.chdir(os.path.abspath(os.path.join(os.getcwd(), os.pardir)))
+
+    parser = argparse.ArgumentParser(description="Precompute the skim matrix of a city")
+    parser.add_argument("city_config", help="path to the city configuration")
+    parser.add_argument("--workers", type=int, default=os.cpu_count(),
+                        help="number of worker processes")
+    parser.add_argument("--block-size", type=int, default=256,
+                        help="number of source nodes computed and written at once")
+    parser.add_argument("--keep-blocks", action="store_true",
+                        help="keep block files after the matrix is assembled")
+    args = parser.parse_args()
+
+    logger = utc.initialise_logger("INFO")
+    city_config = utc.load_config(args.city_config, logger)
+    skim_path = city_config['paths']['skim_matrix']
+    if not skim_path.endswith('.npy'):
+        skim_path = os.path.splitext(skim_path)[0] + '.npy'
+        logger.warning(f"Precomputed skim is stored in the .npy format, writing to {skim_path}")
+
+    precompute_skim(
+        city_graph=utc.load_city_graph(city_config, logger),
+        skim_path=skim_path,
+        logger=logger,
+        workers=args.workers,
+        block_size=args.block_size,
+        dtype=city_config.get('skim_dtype', 'float64'),
+        keep_blocks=args.keep_blocks
+    )
@@ -12,6 +12,7 @@ from rides.taxi_ride import TaxiRide
 
 from utils.common import compute_distance as dist
 from utils.common import compute_path as find_path
+from utils.skim_tools import PathCache
 
 
 class PoolRide(Ride):
@@ -148,7 +149,9 @@ class PoolRide(Ride):
                       new_profitability: tuple or list,
                       ods_sequence: list,
                       adm_combinations: list[tuple] or list[list],
-                      skim: dict
+                      skim: dict,
+                      path_cache: PathCache or None = None,
+                      reroute: bool = True
                       ) -> None:
         """
         If a ride is considered attractive for the new traveller
@@ -158,6 +161,9 @@ class PoolRide(Ride):
         @param ods_sequence: sequence of origins and destinations along the route
         @param adm_combinations: list of sequences of admissible combinations
         @param skim: skim dictionary
+        @param path_cache: legs computed before, passed to compute_path
+        @param reroute: compute the path of the vehicle along ods_sequence,
+         False if the vehicle is already routed along it
         """
         # Update vehicle
         vehicle = self.serving_vehicle
@@ -166,12 +172,14 @@ class PoolRide(Ride):
         if len(vehicle.scheduled_travellers) + len(vehicle.travellers) >= vehicle.maximal_occupancy:
             vehicle.available = False
 
-        vehicle.path.current_path = find_path(
-            list_of_points=[vehicle.path.current_position] +
-                           [vehicle.path.closest_crossroad] +
-                           [t[0] for t in ods_sequence],
-            skim=skim
-        )
+        if reroute:
+            vehicle.path.current_path = find_path(
+                list_of_points=[vehicle.path.current_position] +
+                               [vehicle.path.closest_crossroad] +
+                               [t[0] for t in ods_sequence],
+                skim=skim,
+                path_cache=path_cache
+            )
 
         # Update self
         self.profitability.revenue = new_profitability[0]
@@ -0,0 +1,62 @@
+""" Small synthetic city shared by the tests """
+import os
+import sys
+import json
+import pickle
+
+import networkx as nx
+import pytest
+
+REPO = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, REPO)
+
+import utils.common as utc  # noqa: E402
+
+
+def grid_city(size: int = 6) -> nx.MultiDiGraph:
+    """ Grid of two-way streets about 130 m long, nodes with coordinates in degrees """
+    city_graph = nx.MultiDiGraph()
+    grid = nx.grid_2d_graph(size, size)
+    labels = {node: 1000 + num for num, node in enumerate(grid.nodes)}
+    for (x, y), label in labels.items():
+        city_graph.add_node(label, x=-73.98 + 0.0012 * x, y=40.75 + 0.0012 * y)
+    for num, (a, b) in enumerate(grid.edges):
+        length = 100 + 7.3 * (num % 11)
+        city_graph.add_edge(labels[a], labels[b], length=length)
+        city_graph.add_edge(labels[b], labels[a], length=length)
+    return city_graph
+
+
+@pytest.fixture(scope="session")
+def city_config(tmp_path_factory) -> dict:
+    directory = tmp_path_factory.mktemp("city")
+    with open(directory / "city.pickle", 'wb') as f:
+        pickle.dump(grid_city(), f)
+    return {"city": "grid",
+            "paths": {"city_graph": str(directory / "city.pickle"),
+                      "skim_matrix": str(directory / "skim.npy")}}
+
+
+@pytest.fixture(scope="session")
+def logger():
+    return utc.initialise_logger("ERROR")
+
+
+@pytest.fixture(scope="session")
+def behavioural_config() -> dict:
+    with open(os.path.join(REPO, "data/configs/behavioural_configs/behavioural_config_test.json")) as f:
+        config = json.load(f)
+    # Pickup limit in distance over speed units, as compared by the dispatcher
+    config["maximal_pickup"] = 600000
+    config["pickup_delay_sensitivity"] = 0.01
+    config["pool_rides"]["PfS"] = {k: 1.0 for k in config["pool_rides"]["PfS"]}
+    return config
+
+
+@pytest.fixture(scope="session")
+def fare_config() -> dict:
+    with open(os.path.join(REPO, "data/configs/pricing_configs/fares_test.json")) as f:
+        config = json.load(f)
+    config["fares"]["city_taxi"]["pool_discount"] = 0.6
+    config["operating_costs"]["city_taxi"]["pool"] = 0.0001
+    return config
@@ -0,0 +1,136 @@
+""" Pool ride evaluation against exact and quantized skims """
+import copy
+
+import numpy as np
+import pandas as pd
+import pytest
+
+import utils.common as utc
+import utils.pool_tools
+from base_objects.traveller import Traveller
+from base_objects.vehicle import Vehicle
+from dispatchers.taxidispatcher import TaxiDispatcher
+
+START = pd.Timestamp("2024-01-01 08:00:00")
+
+
+@pytest.fixture(scope="module", params=[None, {"dtype": "uint32", "resolution": 0.1}],
+                ids=["exact", "quantized"])
+def skim(request, city_config, logger):
+    config = copy.deepcopy(city_config)
+    if request.param is not None:
+        config["skim_quantization"] = request.param
+    return utc.load_skim(config, logger)
+
+
+def make_traveller(traveller_id, origin, destination, behavioural_config, skim):
+    request = pd.Series(dict(id=traveller_id, origin=origin, destination=destination,
+                             request_time=str(START), type="pool", operator="city_taxi"))
+    traveller = Traveller(request=tuple(request), behavioural_details=dict(behavioural_config))
+    traveller.calculate_trip_length(skim)
+    return request, traveller
+
+
+@pytest.fixture
+def ongoing_ride(skim, behavioural_config, fare_config):
+    """ Dispatcher with a pool ride serving one traveller """
+    dispatcher = TaxiDispatcher("city_taxi", fare_config["fares"]["city_taxi"],
+                                fare_config["operating_costs"]["city_taxi"],
+                                fleet=pd.DataFrame([dict(type="pool")]), skim=skim)
+    nodes = skim["nodes"].tolist()
+    for vehicle_id, node in enumerate((nodes[0], nodes[-1])):
+        dispatcher.add_vehicle(Vehicle(vehicle_id, node, START, START + pd.Timedelta(hours=3),
+                                       capacity=4, vehicle_speed=6), "pool")
+    request, traveller = make_traveller(0, nodes[1], nodes[-2], behavioural_config, skim)
+    _, offer = dispatcher.pool_utility(request=request, traveller=traveller, skim=skim)
+    dispatcher.assign_taxi(taxi_ride=offer["taxi_ride"], vehicle=offer["vehicle"],
+                           utility=offer["utility"], traveller=traveller,
+                           profitability=offer["profitability"], skim=skim)
+    return dispatcher, next(iter(dispatcher.rides["pool"]))
+
+
+def test_skim_lookup_returns_floats(skim):
+    value = utc.skim_lookup(0, 1, skim)
+    assert np.ndim(value) == 0 and float(value) == pytest.approx(utc.compute_distance(
+        skim["nodes"][[0, 1]].tolist(), skim))
+    assert utc.skim_lookup(np.array([0, 1]), np.array([1, 0]), skim).dtype == np.float64
+
+
+def test_admissible_future_combinations(skim, ongoing_ride):
+    _, ride = ongoing_ride
+    nodes = skim["nodes"].tolist()
+    new_locations = [(nodes[7], 'o', 1), (nodes[-8], 'd', 1)]
+    combinations = utils.pool_tools.admissible_future_combinations(
+        new_locations=new_locations,
+        ride=ride,
+        max_trip_length=np.inf,
+        max_distance_pickup=np.inf,
+        skim=skim
+    )
+    assert combinations
+    for comb in combinations:
+        assert comb.index(new_locations[0]) < comb.index(new_locations[1])
+        assert [t for t in comb if t not in new_locations] in ride.adm_combinations
+
+
+def test_pool_utility(skim, ongoing_ride, behavioural_config):
+    dispatcher, ride = ongoing_ride
+    nodes = skim["nodes"].tolist()
+    request, traveller = make_traveller(1, nodes[7], nodes[-8], behavioural_config, skim)
+    assignments, _ = dispatcher.pool_utility(request=request, traveller=traveller, skim=skim,
+                                             max_candidates=None)
+    assert dispatcher.rejected_rides["pickup"] == 0
+    for assigned_ride, comb, profitability, utility, _ in assignments:
+        assert assigned_ride is ride
+        assert profitability[2] >= ride.profitability.profit
+        assert set(utility) == {traveller} | set(ride.travellers)
+
+
+def grid_node(x, y):
+    """ Node of the test city at the crossing (x, y) """
+    return 1000 + 6 * x + y
+
+
+@pytest.fixture
+def batch(skim, behavioural_config, fare_config):
+    """
+    Dispatcher with one vehicle between the origins of two travellers
+    heading to the same destination across the city, at the discount of the test fares
+    for which sharing pays off for the operator
+    """
+    dispatcher = TaxiDispatcher("city_taxi", dict(fare_config["fares"]["city_taxi"], pool_discount=0.25),
+                                fare_config["operating_costs"]["city_taxi"],
+                                fleet=pd.DataFrame([dict(type="pool")]), skim=skim)
+    vehicle = Vehicle(0, grid_node(0, 2), START, START + pd.Timedelta(hours=3),
+                      capacity=4, vehicle_speed=6)
+    dispatcher.add_vehicle(vehicle, "pool")
+    requests, travellers = zip(*[make_traveller(num, grid_node(0, y), grid_node(5, 2), behavioural_config, skim)
+                                 for num, y in enumerate((1, 3))])
+    return dispatcher, vehicle, list(requests), list(travellers)
+
+
+def test_batch_pool_assignment(skim, batch):
+    dispatcher, vehicle, requests, travellers = batch
+    assert dispatcher.batch_pool_assignment(requests, travellers, skim) == [True, True]
+
+    ride, = dispatcher.rides["pool"]
+    assert ride.serving_vehicle is vehicle and ride.shared
+    assert sorted(traveller.traveller_id for traveller in ride.travellers) == [0, 1]
+    assert sorted(ride.destination_points) == sorted(
+        (request[loc], event, request[0]) for request in requests for loc, event in ((1, 'o'), (2, 'd')))
+    for request in requests:
+        assert ride.destination_points.index((request[1], 'o', request[0])) \
+            < ride.destination_points.index((request[2], 'd', request[0]))
+    assert vehicle.path.current_path == utc.compute_path(
+        [vehicle.path.current_position] + [t[0] for t in ride.destination_points], skim)
+    assert vehicle.path.closest_crossroad == vehicle.path.current_path[1]
+
+
+def test_batch_pool_assignment_maximal_pickup(skim, batch):
+    """ Either traveller is picked up second only after a detour beyond their maximal pickup """
+    dispatcher, vehicle, requests, travellers = batch
+    for request, traveller in zip(requests, travellers):
+        traveller.behavioural_details["maximal_pickup"] = float(utc.skim_lookup(
+            skim["node_index"][vehicle.path.current_position], skim["node_index"][request[1]], skim)) / 6 + 1e-6
+    assert dispatcher.batch_pool_assignment(requests, travellers, skim) == [False, False]
+    assert not dispatcher.rides.get("pool")
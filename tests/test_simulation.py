@@ -0,0 +1,65 @@
+""" Operators simulated in worker processes as in a single one """
+import copy
+import random
+
+import pandas as pd
+import pytest
+
+import utils.common as utc
+from utils.simulation import run_simulation, run_operators_in_parallel
+
+START = pd.Timestamp("2024-01-01 08:00:00")
+OPERATORS = ["A", "B"]
+
+
+@pytest.fixture(scope="module")
+def skim(city_config, logger):
+    return utc.load_skim(city_config, logger)
+
+
+def make_data_bank(skim, logger, behavioural_config, fare_config, simulation_config):
+    rng = random.Random(6)
+    nodes = skim["nodes"].tolist()
+    requests = []
+    for request_id in range(30):
+        origin, destination = rng.sample(nodes, 2)
+        requests.append(dict(id=request_id, origin=origin, destination=destination,
+                             request_time=str(START + pd.Timedelta(seconds=rng.randint(0, 900))),
+                             type="pool", operator=OPERATORS[request_id % 2]))
+    vehicles = []
+    for vehicle_id in range(6):
+        vehicles.append(dict(id=vehicle_id, origin=rng.choice(nodes),
+                             start_time=str(START - pd.Timedelta(minutes=1)),
+                             end_time=str(START + pd.Timedelta(hours=3)),
+                             type="pool", capacity=4, speed=6, operator=OPERATORS[vehicle_id % 2]))
+    fares = fare_config["fares"]["city_taxi"]
+    operating_costs = fare_config["operating_costs"]["city_taxi"]
+    return dict(
+        simulation_config=dict(simulation_config, taxi_operators=OPERATORS, refresh_density=60),
+        logger=logger,
+        requests=pd.DataFrame(requests),
+        vehicles=pd.DataFrame(vehicles),
+        behavioural_config=copy.deepcopy(behavioural_config),
+        fare_config={"fares": {op: dict(fares) for op in OPERATORS},
+                     "operating_costs": {op: dict(operating_costs) for op in OPERATORS}},
+        skim=skim
+    )
+
+
+def outcome(results):
+    return ([(vehicle.vehicle_id, vehicle.events) for vehicle in results["vehicles"]],
+            [ride.events for ride in results["rides"]],
+            [(traveller_id, traveller.service_details.waiting_time, traveller.service_details.resigned)
+             for traveller_id, traveller in results["travellers"].items()])
+
+
+@pytest.mark.parametrize("simulation_config", [{}, {"batch_dispatch": True, "batch_pooling": True}],
+                         ids=["immediate", "batch"])
+def test_parallel_operators_as_single_process(skim, logger, behavioural_config, fare_config,
+                                              simulation_config):
+    single = run_simulation(make_data_bank(skim, logger, behavioural_config, fare_config,
+                                           simulation_config))
+    parallel = run_operators_in_parallel(make_data_bank(skim, logger, behavioural_config, fare_config,
+                                                        simulation_config), workers=2)
+    assert single["rides"]
+    assert outcome(parallel) == outcome(single)
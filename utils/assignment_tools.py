@@ -0,0 +1,51 @@
+""" Assignment of requests to vehicles over a batch of requests """
+import numpy as np
+
+try:
+    from scipy.optimize import linear_sum_assignment
+except ImportError:
+    linear_sum_assignment = None
+
+# Cost of pairs which must not be matched
+INFEASIBLE_COST = 1e12
+
+
+def greedy_assignment(costs: np.ndarray,
+                      feasible: np.ndarray
+                      ) -> list:
+    """
+    Match pairs in the order of increasing cost
+    @param costs: request x vehicle matrix of costs
+    @param feasible: request x vehicle mask of admissible pairs
+    @return: list of (request index, vehicle index)
+    """
+    rows, cols = np.nonzero(feasible)
+    order = np.lexsort((cols, rows, costs[rows, cols]))
+    used_rows, used_cols = set(), set()
+    out = []
+    for row, col in zip(rows[order].tolist(), cols[order].tolist()):
+        if row in used_rows or col in used_cols:
+            continue
+        used_rows.add(row)
+        used_cols.add(col)
+        out.append((row, col))
+    return sorted(out)
+
+
+def solve_assignment(costs: np.ndarray,
+                     feasible: np.ndarray
+                     ) -> list:
+    """
+    Minimal total cost matching of requests to vehicles,
+    linear sum assignment if scipy is available, greedy otherwise
+    @param costs: request x vehicle matrix of costs
+    @param feasible: request x vehicle mask of admissible pairs
+    @return: list of (request index, vehicle index), sorted by request
+    """
+    if costs.size == 0 or not feasible.any():
+        return []
+    if linear_sum_assignment is None:
+        return greedy_assignment(costs, feasible)
+
+    rows, cols = linear_sum_assignment(np.where(feasible, costs, INFEASIBLE_COST))
+    return [(row, col) for row, col in zip(rows.tolist(), cols.tolist()) if feasible[row, col]]
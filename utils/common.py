@@ -13,6 +13,13 @@ import numpy as np
 import osmnx as ox
 import networkx as nx
 
+from utils import skim_tools
+from utils.profiling import Profiler
+from utils.contraction_hierarchy import ContractionHierarchy
+
+EARTH_RADIUS = 6_371_009
+LOWER_BOUND_SLACK = 0.999
+
 
 def initialise_logger(
         logger_level: str or float = 'INFO'
@@ -113,21 +120,16 @@ def folder_creator(
         log_if_logger(logger, 30, f'Creating folder at {path}')
 
 
-def load_skim(
+def load_city_graph(
         city_config: dict,
-        logger: logging.Logger,
-        skim_type: str = 'graph'
-) -> dict:
+        logger: logging.Logger
+) -> nx.Graph:
     """
-    Load data necessarily for distance and paths calculations
+    Load the city graph, downloading it with osmnx if missing
     :param city_config: configuration of the city
     :param logger: for logging purposes
-    :param skim_type: type of configuration for calculations
-    :return: skim - dictionary with way of calculation and data
+    :return: graph with integer node ids
     """
-    if skim_type != 'graph':
-        raise NotImplementedError("Currently only shortest paths implemented")
-
     try:
         # city_graph = nx.read_graphml(city_config['paths']['city_graph'])
         city_graph = pickle.load(open(city_config['paths']['city_graph'], 'rb'))
@@ -141,24 +143,149 @@ def load_skim(
     else:
         logger.warning("Successfully read city graph")
 
-    try:
-        skim_matrix = pd.read_parquet(city_config['paths']['skim_matrix'])
-    except FileNotFoundError:
-        logger.warning("Skim matrix missing, calculating...")
-        skim_matrix = pd.DataFrame(dict(nx.all_pairs_dijkstra_path_length(city_graph, weight='length')))
-        skim_matrix.columns = [str(col) for col in skim_matrix.columns]
+    return nx.relabel_nodes(city_graph, {t: int(t) for t in city_graph.nodes})
+
+
+def _read_skim_matrix(
+        skim_path: str,
+        city_graph: nx.Graph,
+        dtype: str,
+        logger: logging.Logger,
+        workers: int = 1
+) -> (np.ndarray, np.ndarray, np.ndarray or None):
+    """
+    Read the full skim matrix or calculate it if missing
+    :param skim_path: path to the skim matrix (.npy or .parquet)
+    :param city_graph: graph used when the matrix has to be calculated
+    :param dtype: type of stored distances
+    :param logger: for logging purposes
+    :param workers: number of processes computing a missing .npy matrix
+    :return: dense matrix [origin, destination], osmnx node ids in the order of rows,
+     predecessor table [origin, node] (None if not available)
+    """
+    if skim_path.endswith('.npy'):
+        try:
+            distances, nodes, predecessors = skim_tools.load_skim_npy(skim_path)
+        except FileNotFoundError:
+            logger.warning(f"Skim matrix missing, calculating and writing to {skim_path}")
+            distances, nodes, predecessors = skim_tools.precompute_skim(
+                city_graph=city_graph,
+                skim_path=skim_path,
+                logger=logger,
+                workers=workers,
+                dtype=dtype
+            )
+        else:
+            logger.warning("Successfully memory-mapped skim matrix")
+            if predecessors is None:
+                logger.warning("No predecessor table stored, paths computed with Dijkstra")
+
+    else:
+        try:
+            skim_matrix = pd.read_parquet(skim_path)
+        except FileNotFoundError:
+            logger.warning("Skim matrix missing, calculating...")
+            skim_matrix = pd.DataFrame(dict(nx.all_pairs_dijkstra_path_length(city_graph, weight='length')))
+            skim_matrix.columns = [str(col) for col in skim_matrix.columns]
+
+            logger.warning(f"Writing the skim matrix to {skim_path}")
+            skim_matrix.to_parquet(skim_path, compression='brotli')
+        else:
+            logger.warning("Successfully read skim matrix")
+
+        # Dense array with rows as origins and columns as destinations
+        distances, nodes = skim_tools.frame_to_array(skim_matrix, dtype)
+        predecessors = None
+        del skim_matrix
+
+    return distances, nodes, predecessors
+
+
+def load_skim(
+        city_config: dict,
+        logger: logging.Logger,
+        skim_type: str = 'graph'
+) -> dict:
+    """
+    Load data necessarily for distance and paths calculations
+    :param city_config: configuration of the city
+    :param logger: for logging purposes
+    :param skim_type: type of configuration for calculations:
+     'graph' - full skim matrix, 'dijkstra' - rows computed on demand,
+     'ch' - queries on a contraction hierarchy
+    :return: skim - dictionary with way of calculation and data
+    """
+    if skim_type not in ('graph', 'dijkstra', 'ch'):
+        raise NotImplementedError("Currently only shortest paths implemented")
+
+    city_graph = load_city_graph(city_config, logger)
+    dtype = city_config.get('skim_dtype', 'float64')
+
+    if skim_type == 'dijkstra':
+        # Rows of the skim computed on demand, no full matrix in memory
+        nodes = np.array(list(city_graph.nodes), dtype=np.int64)
+        distances = skim_tools.DijkstraRowCache(
+            city_graph=city_graph,
+            nodes=nodes,
+            maxsize=city_config.get('row_cache_size', 1024),
+            dtype=dtype
+        )
+        predecessors = None
+        logger.warning(f"Skim rows computed on demand, cache size {distances.maxsize}")
+
+    elif skim_type == 'ch':
+        # Preprocessed hierarchy cached next to the city graph
+        ch_path = city_config['paths'].get(
+            'contraction_hierarchy',
+            os.path.splitext(city_config['paths']['city_graph'])[0] + '_ch.pickle'
+        )
+        try:
+            distances = ContractionHierarchy.load(ch_path)
+        except FileNotFoundError:
+            distances = None
+        else:
+            logger.warning("Successfully read contraction hierarchy")
+
+        if distances is None or set(distances.nodes.tolist()) != set(city_graph.nodes):
+            logger.warning("Contraction hierarchy missing or outdated, preprocessing...")
+            distances = ContractionHierarchy.from_graph(city_graph, logger=logger)
+            logger.warning(f"Writing the contraction hierarchy to {ch_path}")
+            distances.save(ch_path)
+        nodes = distances.nodes
+        predecessors = None
 
-        logger.warning(f"Writing the skim matrix to {city_config['paths']['skim_matrix']}")
-        skim_matrix.to_parquet(city_config['paths']['skim_matrix'], compression='brotli')
-        city_config['paths']['skim_matrix'] = city_config['paths']['skim_matrix']
     else:
-        logger.warning("Successfully read skim matrix")
+        distances, nodes, predecessors = _read_skim_matrix(
+            skim_path=city_config['paths']['skim_matrix'],
+            city_graph=city_graph,
+            dtype=dtype,
+            logger=logger,
+            workers=city_config.get('skim_workers', 1)
+        )
+        if city_config.get('skim_quantization') is not None:
+            distances = skim_tools.load_quantized_skim(
+                distances=distances,
+                skim_path=city_config['paths']['skim_matrix'],
+                logger=logger,
+                **city_config['skim_quantization']
+            )
+
+    # Node coordinates (lat, lon) in radians, used for lower bounds of distances
+    coordinates = np.radians(np.array(
+        [(city_graph.nodes[node].get('y', np.nan), city_graph.nodes[node].get('x', np.nan))
+         for node in nodes.tolist()],
+        dtype=np.float64
+    ).reshape(-1, 2))
 
-    skim_matrix.columns = [int(t) for t in skim_matrix.columns]
-    city_graph = nx.relabel_nodes(city_graph, {t: int(t) for t in city_graph.nodes})
     logger.error("Skim matrix and city graphs loaded")
 
-    return {"type": "graph", "city_graph": city_graph, "skim_matrix": skim_matrix}
+    return {"type": skim_type,
+            "city_graph": city_graph,
+            "skim_matrix": distances,
+            "predecessors": predecessors,
+            "nodes": nodes,
+            "coordinates": coordinates,
+            "node_index": {node: num for num, node in enumerate(nodes.tolist())}}
 
 
 def load_any_excel(path: str
@@ -201,7 +328,7 @@ def initialise_data_simulation(
     city_config = load_config(simulation_config["city_config"], logger)
     behavioural_config = load_config(simulation_config["behavioural_config"], logger)
     fare_config = load_config(simulation_config["fares_config"], logger)
-    skim = load_skim(city_config, logger)
+    skim = load_skim(city_config, logger, city_config.get("skim_type", "graph"))
     return {
         "simulation_config": simulation_config,
         "logger": logger,
@@ -259,20 +386,104 @@ def compute_distance(
 ) -> float:
     """ Compute distance between points in the city """
     assert len(list_of_points) >= 2
+    matrix = skim["skim_matrix"]
+    index = skim["node_index"]
     if len(list_of_points) == 2:
         if list_of_points[0] == list_of_points[1]:
             return 0
-        return skim["skim_matrix"].loc[list_of_points[1], list_of_points[0]]
+        return float(matrix[index[list_of_points[0]], index[list_of_points[1]]])
     dist = 0
     current_node = list_of_points[0]
     for node in list_of_points[1:]:
         if node == current_node:
             continue
-        dist += skim["skim_matrix"].loc[node, current_node]
+        dist += float(matrix[index[current_node], index[node]])
         current_node = node
     return dist
 
 
+def route_indices(
+        routes: list,
+        skim: dict
+) -> np.ndarray:
+    """
+    Translate sequences of city nodes into dense skim indices
+    @param routes: list of node sequences, possibly of different lengths
+    @param skim: skim dictionary
+    @return: 2-D array with one route per row, shorter routes padded with -1
+    """
+    index = skim["node_index"]
+    width = max(len(route) for route in routes)
+    out = np.full((len(routes), width), -1, dtype=np.int64)
+    for num, route in enumerate(routes):
+        out[num, :len(route)] = [index[node] for node in route]
+    return out
+
+
+def skim_lookup(
+        origins: np.ndarray,
+        destinations: np.ndarray,
+        skim: dict
+) -> np.ndarray:
+    """ Gather distances between dense indices of origins and destinations """
+    # Quantized and hierarchy skims return plain floats for single pairs
+    return np.asarray(skim["skim_matrix"][origins, destinations], dtype=np.float64)
+
+
+def compute_distances_batch(
+        routes: np.ndarray,
+        skim: dict
+) -> np.ndarray:
+    """
+    Compute lengths of many routes at once, consistent with compute_distance
+    @param routes: 2-D array of dense skim indices (see route_indices),
+     one route per row, padded at the end with -1
+    @param skim: skim dictionary
+    @return: array with the length of each route
+    """
+    routes = np.array(routes, dtype=np.int64, ndmin=2)
+    if routes.shape[1] < 2:
+        return np.zeros(routes.shape[0])
+
+    # Padding repeats the last visited node, hence adds no distance
+    for col in range(1, routes.shape[1]):
+        padded = routes[:, col] < 0
+        routes[padded, col] = routes[padded, col - 1]
+
+    origins = routes[:, :-1]
+    destinations = routes[:, 1:]
+    legs = skim_lookup(origins, destinations, skim)
+    legs[origins == destinations] = 0
+    return legs.sum(axis=1)
+
+
+def distance_lower_bound(
+        origins: int or list,
+        destinations: int or list,
+        skim: dict
+) -> np.ndarray:
+    """
+    Great-circle distance between city nodes, never longer than the network distance.
+    Cheap to compute, hence used to discard candidates before exact skim lookups
+    @param origins: node or list of nodes
+    @param destinations: node or list of nodes (broadcast against origins)
+    @param skim: skim dictionary
+    @return: array of lower bounds in metres (0 where coordinates are unknown)
+    """
+    index = skim["node_index"]
+    coordinates = skim["coordinates"]
+    origins = coordinates[[index[node] for node in np.ravel(origins).tolist()]]
+    destinations = coordinates[[index[node] for node in np.ravel(destinations).tolist()]]
+
+    lat_1, lon_1 = origins[:, 0], origins[:, 1]
+    lat_2, lon_2 = destinations[:, 0], destinations[:, 1]
+    haversine = np.sin((lat_2 - lat_1) / 2) ** 2
+    haversine = haversine + np.cos(lat_1) * np.cos(lat_2) * np.sin((lon_2 - lon_1) / 2) ** 2
+    bound = 2 * EARTH_RADIUS * np.arcsin(np.sqrt(np.clip(haversine, 0, 1)))
+    # Slack for rounding of edge lengths
+    return np.nan_to_num(bound * LOWER_BOUND_SLACK, nan=0)
+
+
 def difference_times(time1, time2) -> int:
     """ Calculate difference between times """
     def amend_time_type(time):
@@ -285,26 +496,81 @@ def difference_times(time1, time2) -> int:
     return int((time1 - time2).total_seconds())
 
 
+def path_from_predecessors(
+        source: int,
+        target: int,
+        skim: dict
+) -> list:
+    """
+    Rebuild the shortest path by walking back the predecessor table
+    @param source: osmnx id of the first node
+    @param target: osmnx id of the last node
+    @param skim: skim dictionary
+    @return: list of nodes from source to target
+    """
+    index = skim["node_index"]
+    source_id = index[source]
+    if skim["type"] == "dijkstra":
+        predecessors = skim["skim_matrix"].predecessor_row(source_id)
+    else:
+        predecessors = skim["predecessors"][source_id]
+
+    path = [index[target]]
+    while path[-1] != source_id:
+        previous = int(predecessors[path[-1]])
+        if previous < 0:
+            raise nx.NetworkXNoPath(f"Node {target} not reachable from {source}")
+        path.append(previous)
+    return skim["nodes"][path[::-1]].tolist()
+
+
+def _shortest_leg(
+        source: int,
+        target: int,
+        skim: dict
+) -> list:
+    """ Nodes of the shortest path after the source up to the target """
+    if skim["type"] == "ch":
+        index = skim["node_index"]
+        leg = skim["skim_matrix"].shortest_path(index[source], index[target])
+        return skim["nodes"][leg[1:]].tolist()
+    if skim["type"] in ("graph", "dijkstra"):
+        if skim["type"] == "dijkstra" or skim.get("predecessors") is not None:
+            return path_from_predecessors(source, target, skim)[1:]
+        return nx.dijkstra_path(
+            G=skim["city_graph"],
+            source=source,
+            target=target,
+            weight='length'
+        )[1:]
+    raise NotImplementedError("Currently not implemented")
+
+
 def compute_path(
         list_of_points: list,
-        skim: dict
+        skim: dict,
+        path_cache: skim_tools.PathCache or None = None
 ) -> list:
-    """ Calculate the shortest path between two city points """
+    """
+    Calculate the shortest path through consecutive city points
+    @param list_of_points: nodes to be visited in order
+    @param skim: skim dictionary
+    @param path_cache: legs computed before, reused and extended if given
+    @return: list of nodes
+    """
     assert len(list_of_points) >= 2
-    if skim["type"] == "graph":
-        current_node = list_of_points[0]
-        path = [current_node]
-        for node in list_of_points[1:]:
-            path += nx.dijkstra_path(
-                G=skim["city_graph"],
-                source=current_node,
-                target=node,
-                weight='length'
-            )[1:]
-            current_node = node
-    else:
+    if skim["type"] not in ("ch", "graph", "dijkstra"):
         raise NotImplementedError("Currently not implemented")
 
+    path = [list_of_points[0]]
+    for current_node, node in zip(list_of_points[:-1], list_of_points[1:]):
+        leg = path_cache.get(current_node, node) if path_cache is not None else None
+        if leg is None:
+            leg = _shortest_leg(current_node, node, skim)
+            if path_cache is not None:
+                path_cache.put(current_node, node, leg)
+        path += leg
+
     return path
 
 
@@ -314,7 +580,8 @@ def post_hoc_analysis(
         travellers: dict,
         config: dict,
         skim: dict,
-        logger: logging.Logger or None = None
+        logger: logging.Logger or None = None,
+        profiler: Profiler or None = None
 ) -> None:
     """
     Analyse run
@@ -324,6 +591,7 @@ def post_hoc_analysis(
     @param config: simulation configuration
     @param skim: to compute distances
     @param logger: logger for logging purposes
+    @param profiler: timings of the run, saved if enabled
     @return: None
     """
 
@@ -452,4 +720,7 @@ def post_hoc_analysis(
         file.write("Total profits: ".ljust(25) + str(revenue) + '\n')
         file.write("Total costs: ".ljust(25) + str(costs))
 
+    if profiler is not None and profiler.enabled:
+        profiler.write(config["output_path"] + str(date.today()) + '/profiling_results.txt')
+
     logger.error("Post-hoc analysis finished, results saved")
@@ -0,0 +1,242 @@
+""" Contraction hierarchy for point-to-point shortest path queries """
+import heapq
+import pickle
+import logging
+
+import numpy as np
+import networkx as nx
+
+
+class ContractionHierarchy:
+    """
+    Road graph preprocessed by contracting nodes in order of importance.
+    Queries run a bidirectional Dijkstra restricted to edges leading
+    to more important nodes. Indexed like the dense skim matrix,
+    [origin, destination] with dense node indices
+    """
+
+    def __init__(self,
+                 nodes: np.ndarray,
+                 rank: list,
+                 upward: list,
+                 downward: list,
+                 middle: dict
+                 ):
+        """
+        @param nodes: osmnx node ids, position in the array is the dense index
+        @param rank: order in which the nodes were contracted
+        @param upward: for each node (neighbour, length) of edges to higher-ranked nodes
+        @param downward: for each node (neighbour, length) of edges from higher-ranked nodes
+        @param middle: (from, to) -> contracted node bypassed by the shortcut
+        """
+        self.nodes = nodes
+        self.rank = rank
+        self.upward = upward
+        self.downward = downward
+        self.middle = middle
+        self.shape = (len(nodes), len(nodes))
+
+    def __repr__(self):
+        return f"ContractionHierarchy: {len(self.nodes)} nodes, {len(self.middle)} shortcuts"
+
+    def __getitem__(self, key):
+        origins, destinations = key
+        if np.ndim(origins) == 0 and np.ndim(destinations) == 0:
+            return self.distance(int(origins), int(destinations))
+
+        origins, destinations = np.broadcast_arrays(np.asarray(origins), np.asarray(destinations))
+        return np.array([self.distance(int(o), int(d)) for o, d in
+                         zip(origins.ravel(), destinations.ravel())]).reshape(origins.shape)
+
+    @classmethod
+    def from_graph(cls,
+                   city_graph: nx.Graph,
+                   witness_limit: int = 500,
+                   logger: logging.Logger or None = None
+                   ):
+        """
+        Contract the city graph
+        @param city_graph: networkx graph with 'length' on edges
+        @param witness_limit: number of nodes settled in a witness search
+        @param logger: for logging purposes
+        @return: ContractionHierarchy
+        """
+        nodes = np.array(list(city_graph.nodes), dtype=np.int64)
+        index = {node: num for num, node in enumerate(nodes.tolist())}
+        n_nodes = len(nodes)
+
+        # Parallel edges collapsed to the shortest one
+        out_edges = [{} for _ in range(n_nodes)]
+        in_edges = [{} for _ in range(n_nodes)]
+        for u, w, length in city_graph.edges(data='length'):
+            u, w = index[u], index[w]
+            if u != w and length < out_edges[u].get(w, np.inf):
+                out_edges[u][w] = length
+                in_edges[w][u] = length
+
+        middle = {}
+        contracted = [False] * n_nodes
+        deleted_neighbours = [0] * n_nodes
+        rank = [0] * n_nodes
+
+        def witness_search(source, excluded, max_length, targets):
+            """ Distances from the source avoiding the excluded node """
+            dist = {source: 0}
+            queue = [(0, source)]
+            remaining = set(targets)
+            settled = 0
+            while queue and remaining and settled < witness_limit:
+                length, node = heapq.heappop(queue)
+                if length > dist[node]:
+                    continue
+                if length > max_length:
+                    break
+                remaining.discard(node)
+                settled += 1
+                for neighbour, edge_length in out_edges[node].items():
+                    if neighbour == excluded or contracted[neighbour]:
+                        continue
+                    new_length = length + edge_length
+                    if new_length < dist.get(neighbour, np.inf):
+                        dist[neighbour] = new_length
+                        heapq.heappush(queue, (new_length, neighbour))
+            return dist
+
+        def shortcuts(node):
+            """ Shortcuts required to preserve distances once the node is contracted """
+            out = []
+            outgoing = [(w, length) for w, length in out_edges[node].items() if not contracted[w]]
+            for u, in_length in in_edges[node].items():
+                if contracted[u]:
+                    continue
+                targets = {w: in_length + out_length for w, out_length in outgoing if w != u}
+                if not targets:
+                    continue
+                dist = witness_search(u, node, max(targets.values()), targets)
+                out += [(u, w, length) for w, length in targets.items()
+                        if dist.get(w, np.inf) > length]
+            return out
+
+        def priority(node):
+            degree = sum(not contracted[t] for t in in_edges[node])
+            degree += sum(not contracted[t] for t in out_edges[node])
+            return len(shortcuts(node)) - degree + deleted_neighbours[node]
+
+        queue = [(priority(node), node) for node in range(n_nodes)]
+        heapq.heapify(queue)
+        order = 0
+        while queue:
+            _, node = heapq.heappop(queue)
+            # Lazy update: postpone if the node became more important
+            new_priority = priority(node)
+            if queue and new_priority > queue[0][0]:
+                heapq.heappush(queue, (new_priority, node))
+                continue
+
+            for u, w, length in shortcuts(node):
+                if length < out_edges[u].get(w, np.inf):
+                    out_edges[u][w] = length
+                    in_edges[w][u] = length
+                    middle[(u, w)] = node
+
+            contracted[node] = True
+            rank[node] = order
+            order += 1
+            for neighbour in set(in_edges[node]) | set(out_edges[node]):
+                deleted_neighbours[neighbour] += 1
+
+            if logger is not None and order % max(n_nodes // 10, 1) == 0:
+                logger.warning(f"Contracted {order}/{n_nodes} nodes, {len(middle)} shortcuts")
+
+        upward = [[(w, length) for w, length in out_edges[u].items() if rank[w] > rank[u]]
+                  for u in range(n_nodes)]
+        downward = [[(u, length) for u, length in in_edges[w].items() if rank[u] > rank[w]]
+                    for w in range(n_nodes)]
+        return cls(nodes, rank, upward, downward, middle)
+
+    def save(self, path: str) -> None:
+        """ Store the preprocessed hierarchy """
+        with open(path, 'wb') as file:
+            pickle.dump(self, file, protocol=pickle.HIGHEST_PROTOCOL)
+
+    @staticmethod
+    def load(path: str):
+        """ Read the preprocessed hierarchy """
+        with open(path, 'rb') as file:
+            return pickle.load(file)
+
+    def _search(self,
+                source: int,
+                target: int
+                ) -> (float, int or None, dict, dict):
+        """
+        Bidirectional search on the hierarchy
+        @return: distance, meeting node, forward and backward parents
+        """
+        dist = ({source: 0}, {target: 0})
+        parents = ({source: None}, {target: None})
+        queues = ([(0, source)], [(0, target)])
+        graphs = (self.upward, self.downward)
+        best, meeting = (0, source) if source == target else (np.inf, None)
+
+        direction = 0
+        while queues[0] or queues[1]:
+            if not queues[direction]:
+                direction = 1 - direction
+            length, node = heapq.heappop(queues[direction])
+            if length > dist[direction][node]:
+                continue
+            if length >= best:
+                queues[direction].clear()
+                continue
+
+            other_length = dist[1 - direction].get(node)
+            if other_length is not None and length + other_length < best:
+                best, meeting = length + other_length, node
+
+            for neighbour, edge_length in graphs[direction][node]:
+                new_length = length + edge_length
+                if new_length < dist[direction].get(neighbour, np.inf):
+                    dist[direction][neighbour] = new_length
+                    parents[direction][neighbour] = node
+                    heapq.heappush(queues[direction], (new_length, neighbour))
+            direction = 1 - direction
+
+        return best, meeting, parents[0], parents[1]
+
+    def distance(self, source: int, target: int) -> float:
+        """
+        Shortest path length
+        @param source: dense index of the origin
+        @param target: dense index of the destination
+        @return: length, inf if not reachable
+        """
+        return self._search(source, target)[0]
+
+    def shortest_path(self, source: int, target: int) -> list:
+        """
+        Shortest path with shortcuts unpacked
+        @param source: dense index of the origin
+        @param target: dense index of the destination
+        @return: dense indices of nodes along the path
+        """
+        _, meeting, forward, backward = self._search(source, target)
+        if meeting is None:
+            raise nx.NetworkXNoPath(f"Node {self.nodes[target]} not reachable from {self.nodes[source]}")
+
+        hierarchy_path = [meeting]
+        while forward[hierarchy_path[0]] is not None:
+            hierarchy_path.insert(0, forward[hierarchy_path[0]])
+        while backward[hierarchy_path[-1]] is not None:
+            hierarchy_path.append(backward[hierarchy_path[-1]])
+
+        path = [source]
+        for u, w in zip(hierarchy_path[:-1], hierarchy_path[1:]):
+            stack = [(u, w)]
+            while stack:
+                edge = stack.pop()
+                if edge in self.middle:
+                    stack += [(self.middle[edge], edge[1]), (edge[0], self.middle[edge])]
+                else:
+                    path.append(edge[1])
+        return path
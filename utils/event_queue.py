@@ -0,0 +1,72 @@
+""" Queue of simulation events ordered by time """
+import heapq
+from itertools import count
+
+
+class EventQueue:
+    """
+    Events (time, type, details) in a binary heap, popped in the order of (time, type)
+    and, among equal ones, in the order they were pushed - as when the list of events
+    is kept sorted with a stable sort. Events without type come first at their time.
+    Cancelled events are dropped lazily when they reach the top
+    """
+
+    def __init__(self, events: list or None = None):
+        """
+        @param events: initial events, in the order they would be pushed
+        """
+        self._heap = []
+        self._order = count()
+        self._live = 0
+        for event in events or []:
+            self.push(event)
+
+    def __len__(self):
+        return self._live
+
+    def __bool__(self):
+        return self._live > 0
+
+    def push(self, event: tuple, order: tuple or None = None) -> list:
+        """
+        Schedule an event
+        @param event: (time, type, details)
+        @param order: position among events of equal (time, type), instead of the order
+         of pushing, e.g. to merge queues; the same kind for all events of the queue
+        @return: entry of the event, to cancel it
+        """
+        entry = [event[0], event[1] if event[1] is not None else '',
+                 next(self._order) if order is None else order, event]
+        heapq.heappush(self._heap, entry)
+        self._live += 1
+        return entry
+
+    def cancel(self, entry: list) -> None:
+        """ Remove the scheduled event, if not popped or cancelled already """
+        if entry[3] is not None:
+            entry[3] = None
+            self._live -= 1
+
+    def peek(self) -> tuple:
+        """ The next event, left in the queue """
+        self._drop_cancelled()
+        return self._heap[0][3]
+
+    def next_key(self) -> tuple:
+        """ (time, type, order) by which the next event is popped """
+        self._drop_cancelled()
+        return tuple(self._heap[0][:3])
+
+    def pop(self) -> tuple:
+        """ Remove and return the next event """
+        self._drop_cancelled()
+        entry = heapq.heappop(self._heap)
+        event, entry[3] = entry[3], None
+        self._live -= 1
+        return event
+
+    def _drop_cancelled(self) -> None:
+        while self._heap and self._heap[0][3] is None:
+            heapq.heappop(self._heap)
+        if not self._heap:
+            raise IndexError("No events scheduled")
@@ -21,6 +21,7 @@ def move_vehicle_ride(vehicle: Vehicle,
     :param skim: dictionary with distances
     :param simulation_config: simulation configuration
     :param logger: logging purposes
+    :param dispatcher: dispatcher whose indexes follow the vehicle
     @type vehicle: Vehicle
     @type ride: Ride
     @type move_time: int
@@ -154,6 +155,9 @@ def move_vehicle_ride(vehicle: Vehicle,
     if vehicle.path.current_time >= vehicle.path.end_time:
         vehicle.available = False
 
+    if kwargs.get('dispatcher') is not None:
+        kwargs['dispatcher'].update_vehicle(vehicle)
+
     utc.log_if_logger(kwargs.get("logger"), 10,
                          f"{vehicle.path.current_time}:"
                          f" Vehicle {vehicle} moved by {move_time}s")
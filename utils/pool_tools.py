@@ -1,8 +1,11 @@
-from itertools import permutations
-import time
+import heapq
+from itertools import permutations, count
 from collections import Counter
+
+import numpy as np
+
 from rides.pool_ride import PoolRide
-from utils.common import compute_distance as dist
+from utils.common import skim_lookup, compute_distance
 
 
 # def admissible_future_combinations(
@@ -42,8 +45,7 @@ def admissible_future_combinations(
         ride: PoolRide,
         max_trip_length: float,
         max_distance_pickup: float,
-        skim: dict,
-        execution_time: bool = True
+        skim: dict
 ) -> list:
     """
     Look at the admissible combinations for the ride.
@@ -55,35 +57,219 @@ def admissible_future_combinations(
     @param max_trip_length:
     @param max_distance_pickup:
     @param skim:
-    @param execution_time:
     @return:
     """
-    if execution_time:
-        start_time = time.time()
-
     all_combinations = ride.adm_combinations
+    crossroad = ride.serving_vehicle.path.closest_crossroad
+    index = skim["node_index"]
+    origin, destination = index[new_locations[0][0]], index[new_locations[1][0]]
+    origin_destination = float(_legs(origin, destination, skim))
     out = []
 
     for combination in all_combinations:
-        for i in range(len(combination)):
-            c1 = combination.copy()
-            c1.insert(i, new_locations[0])
+        n_points = len(combination)
+        if n_points == 0:
+            continue
+
+        # Legs of the current sequence once, lengths from its start as prefix sums
+        nodes = np.array([index[t[0]] for t in combination], dtype=np.int64)
+        legs = _legs(nodes[:-1], nodes[1:], skim)
+        prefix = np.concatenate([[0], np.cumsum(legs)])
+        total = prefix[-1]
+        to_origin = _legs(nodes, origin, skim)
+        from_origin = _legs(origin, nodes, skim)
+        to_destination = _legs(nodes, destination, skim)
+        from_destination = _legs(destination, nodes, skim)
+
+        # Distance to the new origin inserted before the i-th point
+        pickups = np.empty(n_points)
+        pickups[0] = _legs(index[crossroad], origin, skim)
+        pickups[1:] = _legs(index[crossroad], nodes[0], skim) + prefix[:-1][:n_points - 1] + to_origin[:-1]
+
+        # Change of the length when the origin is inserted before the i-th point,
+        # the destination after the k-th point (or right after the origin)
+        before_origin = np.concatenate([[0], to_origin[:-1] - legs])
+        origin_costs = before_origin + from_origin
+        destination_costs = to_destination + np.concatenate([from_destination[1:] - legs, [0]])
+
+        for i in np.flatnonzero(pickups <= max_distance_pickup).tolist():
+            if total + before_origin[i] + origin_destination + from_destination[i] < max_trip_length:
+                out.append(combination[:i] + [new_locations[0], new_locations[1]] + combination[i:])
+
+            lengths = total + origin_costs[i] + destination_costs[i:]
+            for k in np.flatnonzero(lengths < max_trip_length).tolist():
+                k += i
+                out.append(combination[:i] + [new_locations[0]] + combination[i:k + 1]
+                           + [new_locations[1]] + combination[k + 1:])
+
+    return out
+
+
+def _legs(origins, destinations, skim: dict) -> np.ndarray:
+    """ Distances between dense indices, zero between the same nodes as in compute_distance """
+    legs = skim_lookup(origins, destinations, skim)
+    return np.where(np.equal(origins, destinations), 0, legs)
+
+
+def _sequential_sum(initial: np.ndarray,
+                    values: np.ndarray,
+                    mask: np.ndarray
+                    ) -> np.ndarray:
+    """
+    Row-wise sum of the selected values added one by one to the initial value,
+    same order of additions (hence rounding) as in compute_distance
+    """
+    return np.cumsum(np.column_stack([initial, np.where(mask, values, 0)]), axis=1)[:, -1]
+
+
+def score_utilities(ride: PoolRide,
+                    travellers: list,
+                    combinations: list,
+                    fare: float,
+                    pool_discount: float,
+                    skim: dict
+                    ) -> np.ndarray:
+    """
+    Utilities of travellers for each of the combinations at once,
+    the same values as PoolRide.calculate_utility
+    @param ride: ongoing pool ride
+    @param travellers: travellers of the ride and the new traveller
+    @param combinations: sequences of (node, event, traveller) of equal length
+    @param fare: fare in monetary units/meter
+    @param pool_discount: discount for a pooled ride
+    @param skim: skim dictionary
+    @return: array combinations x travellers
+    """
+    vehicle = ride.serving_vehicle
+    index = skim["node_index"]
+    nodes = np.array([[index[t[0]] for t in comb] for comb in combinations], dtype=np.int64)
+    legs = _legs(nodes[:, :-1], nodes[:, 1:], skim)
+    positions = np.arange(legs.shape[1])
+    zeros = np.zeros(len(combinations))
+    from_crossroad = _legs(index[vehicle.path.closest_crossroad], nodes[:, 0], skim)
 
-            to_pick_up = [ride.serving_vehicle.path.closest_crossroad]
-            to_pick_up += [t[0] for t in c1[:(i+1)]]
-            if dist(to_pick_up, skim) > max_distance_pickup:
-                continue
+    fare_updated = fare * (1 - pool_discount)
+    no_travellers = len(ride.travellers) + 1
+    out = np.empty((len(combinations), len(travellers)))
+    for num, traveller in enumerate(travellers):
+        events = [{t[1]: pos for pos, t in enumerate(comb) if t[2] == traveller.traveller_id}
+                  for comb in combinations]
+        finish = np.array([event['d'] for event in events])
 
-            for j in range(i+1, len(combination)+2):
-                c2 = c1.copy()
-                c2.insert(j, new_locations[1])
+        if traveller.service_details.pickup_delay is not None:
+            # Already picked up, fixed part of the trip till the closest crossroad
+            pickup_delay = traveller.service_details.pickup_delay
+            start = [node for node in ride.past_destination_points
+                     if (node[1] == 'o' and node[2] == traveller.traveller_id)][0]
+            start_id = ride.past_destination_points.index(start)
+            trip = [t[0] for t in ride.past_destination_points[start_id:]]
+            trip += [vehicle.path.current_position, vehicle.path.closest_crossroad]
+            past_length = compute_distance(trip, skim)
+            trip_length = _sequential_sum(
+                _sequential_sum(zeros + past_length, from_crossroad[:, None], True),
+                legs, positions[None, :] < finish[:, None]
+            )
+        else:
+            start = np.array([event['o'] for event in events])
+            pickup_delay = _sequential_sum(
+                _sequential_sum(zeros, from_crossroad[:, None], True),
+                legs, positions[None, :] < start[:, None]
+            )
+            pickup_delay *= vehicle.vehicle_speed
+            pickup_delay += vehicle.path.to_closest_crossroads
+            trip_length = _sequential_sum(
+                zeros, legs, (positions[None, :] >= start[:, None]) & (positions[None, :] < finish[:, None])
+            )
 
-                total_trip = [ride.serving_vehicle.path.closest_crossroad]
-                total_trip += [t[0] for t in c2]
-                if dist([t[0] for t in c2], skim) < max_trip_length:
-                    out.append(c2)
+        pref = traveller.behavioural_details
+        trip_time = trip_length / vehicle.vehicle_speed
 
-    if execution_time:
-        print(f"--- Combinations found in {time.time() - start_time} seconds ---")
+        utility = -trip_length * fare_updated
+        utility -= trip_time * pref['VoT'] * pref['pool_rides']['PfS'][str(no_travellers)]
+        utility -= pickup_delay * pref['VoT'] * pref['pickup_delay_sensitivity']
+        utility -= pref['pool_rides']['PfS_const']
+        out[:, num] = utility
 
     return out
+
+
+def score_profitability(ride: PoolRide,
+                        traveller,
+                        combinations: list,
+                        fare: float,
+                        operating_cost: float,
+                        sharing_discount: float,
+                        skim: dict
+                        ) -> np.ndarray:
+    """
+    Profitability of the ride with the new traveller for each of the combinations at once,
+    the same values as PoolRide.calculate_profitability
+    @param ride: ongoing pool ride
+    @param traveller: new Traveller
+    @param combinations: sequences of (node, event, traveller) of equal length
+    @param fare: fare in monetary units/meter
+    @param operating_cost: operating cost in units/meter
+    @param sharing_discount: discount for a pooled ride
+    @param skim: skim dictionary
+    @return: array combinations x (revenue, cost, profit)
+    """
+    index = skim["node_index"]
+    travellers = ride.travellers + [traveller]
+    revenue = sum(t.request_details.trip_length for t in travellers)
+    revenue *= fare * (1 - sharing_discount)
+
+    nodes = np.array([[index[t[0]] for t in comb] for comb in combinations], dtype=np.int64)
+    legs = _legs(nodes[:, :-1], nodes[:, 1:], skim)
+    length = np.zeros(len(combinations))
+    past = [t[1] for t in ride.events]
+    if past:
+        if len(past) >= 2:
+            length += compute_distance(past, skim)
+        length = _sequential_sum(length, _legs(index[past[-1]], nodes[:, 0], skim)[:, None], True)
+    length = _sequential_sum(length, legs, True)
+
+    cost = length * operating_cost
+    return np.column_stack([np.full(len(combinations), revenue), cost, revenue - cost])
+
+
+class RankedCandidates:
+    """
+    Bounded collection of pool assignments kept in the order used
+    to choose among them: ascending profitability, ties in the order found.
+    Holds only the first k of that order, in a heap with the last of them on top
+    """
+
+    def __init__(self, k: int or None = 1):
+        """
+        @param k: number of candidates to keep, None to keep all
+        """
+        self.k = k
+        self.seen = 0
+        self._heap = []
+        self._order = count()
+
+    def __len__(self):
+        return len(self._heap)
+
+    @property
+    def full(self) -> bool:
+        return self.k is not None and len(self._heap) >= self.k
+
+    def admits(self, profit: float) -> bool:
+        """ Whether a candidate of the profit found now would be kept """
+        return not self.full or profit < -self._heap[0][0]
+
+    def push(self, profit: float, candidate: tuple) -> None:
+        """ Offer a candidate, dropping the last kept one if over the limit """
+        self.seen += 1
+        if self.k is not None and self.k <= 0:
+            return
+        item = (-profit, -next(self._order), candidate)
+        if self.full:
+            heapq.heappushpop(self._heap, item)
+        else:
+            heapq.heappush(self._heap, item)
+
+    def ranked(self) -> list:
+        """ Kept candidates, the first to be chosen first """
+        return [item[2] for item in sorted(self._heap, key=lambda x: (-x[0], -x[1]))]
@@ -0,0 +1,137 @@
+""" Timings of dispatching stages and counts of evaluated candidates """
+import math
+import time
+from collections import Counter
+from contextlib import contextmanager, nullcontext
+
+
+class Histogram:
+    """
+    Durations in logarithmic buckets: constant memory,
+    percentiles within the relative width of a bucket
+    """
+
+    # Smallest resolved duration in seconds and the ratio of consecutive buckets
+    BASE = 1e-6
+    RATIO = 2 ** (1 / 8)
+
+    def __init__(self):
+        self.buckets = Counter()
+        self.count = 0
+        self.total = 0.0
+        self.max = 0.0
+
+    def add(self, value: float) -> None:
+        """ Record a duration in seconds """
+        bucket = int(math.log(value / self.BASE, self.RATIO)) + 1 if value > self.BASE else 0
+        self.buckets[bucket] += 1
+        self.count += 1
+        self.total += value
+        self.max = max(self.max, value)
+
+    def merge(self, other: "Histogram") -> None:
+        """ Add durations recorded elsewhere """
+        self.buckets.update(other.buckets)
+        self.count += other.count
+        self.total += other.total
+        self.max = max(self.max, other.max)
+
+    def percentile(self, q: float) -> float:
+        """
+        Duration not exceeded by the share q of records
+        @param q: between 0 and 1
+        @return: upper end of the bucket, in seconds
+        """
+        if not self.count:
+            return 0.0
+        rank = q * self.count
+        seen = 0
+        for bucket in sorted(self.buckets):
+            seen += self.buckets[bucket]
+            if seen >= rank:
+                return min(self.BASE * self.RATIO ** bucket, self.max)
+        return self.max
+
+    def summary(self) -> dict:
+        return {"count": self.count,
+                "total": self.total,
+                "mean": self.total / self.count if self.count else 0.0,
+                "p50": self.percentile(0.5),
+                "p99": self.percentile(0.99),
+                "max": self.max}
+
+
+class Profiler:
+    """
+    Histograms of durations of named stages and counters of events.
+    When disabled, timers and counters do nothing
+    """
+
+    def __init__(self, enabled: bool = False):
+        self.enabled = enabled
+        self.stages = {}
+        self.counters = Counter()
+
+    def start(self) -> float or None:
+        """ Beginning of a timed stage, None if disabled """
+        return time.perf_counter() if self.enabled else None
+
+    def stop(self, stage: str, started: float or None) -> None:
+        """
+        Record the duration of a stage
+        @param stage: name of the stage
+        @param started: returned by start
+        """
+        if started is None:
+            return
+        self.record(stage, time.perf_counter() - started)
+
+    def record(self, stage: str, duration: float) -> None:
+        """ Record a duration of a stage in seconds """
+        histogram = self.stages.get(stage)
+        if histogram is None:
+            histogram = self.stages[stage] = Histogram()
+        histogram.add(duration)
+
+    def timer(self, stage: str):
+        """ Context manager timing its body as the stage """
+        if not self.enabled:
+            return nullcontext()
+        return self._timer(stage)
+
+    @contextmanager
+    def _timer(self, stage):
+        started = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.record(stage, time.perf_counter() - started)
+
+    def count(self, counter: str, value: int = 1) -> None:
+        """ Increase the counter """
+        if self.enabled:
+            self.counters[counter] += value
+
+    def merge(self, other: "Profiler") -> None:
+        """ Add records of another profiler, e.g. of a worker process """
+        for stage, histogram in other.stages.items():
+            self.stages.setdefault(stage, Histogram()).merge(histogram)
+        self.counters.update(other.counters)
+
+    def summary(self) -> dict:
+        """ Statistics of stages in seconds and values of counters """
+        return {"stages": {stage: histogram.summary() for stage, histogram in self.stages.items()},
+                "counters": dict(self.counters)}
+
+    def write(self, path: str) -> None:
+        """ Save the summary as a text table """
+        with open(path, 'w', encoding='utf-8') as f:
+            f.write(f"{'stage':<24}{'count':>10}{'total [s]':>14}{'mean [ms]':>12}"
+                    f"{'p50 [ms]':>12}{'p99 [ms]':>12}{'max [ms]':>12}\n")
+            for stage, stats in sorted(self.summary()["stages"].items()):
+                f.write(f"{stage:<24}{stats['count']:>10}{stats['total']:>14.3f}"
+                        f"{1e3 * stats['mean']:>12.3f}{1e3 * stats['p50']:>12.3f}"
+                        f"{1e3 * stats['p99']:>12.3f}{1e3 * stats['max']:>12.3f}\n")
+            f.write("\n")
+            for counter, value in sorted(self.counters.items()):
+                f.write(f"{counter:<24}{value:>10}\n")
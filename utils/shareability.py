@@ -0,0 +1,102 @@
+""" Shareability of requests collected over a dispatch window """
+from itertools import combinations
+
+from utils.common import compute_distances_batch, route_indices
+
+
+def admissible_sequences(locations: list) -> list:
+    """
+    All orders of visiting origins and destinations of travellers,
+    where no destination precedes the corresponding origin
+    @param locations: for each traveller [(node, 'o', traveller), (node, 'd', traveller)]
+    @return: list of sequences of (node, event, traveller)
+    """
+    out = []
+
+    def extend(sequence, waiting, on_board):
+        if not waiting and not on_board:
+            out.append(sequence)
+            return
+        for num in waiting:
+            extend(sequence + [locations[num][0]], waiting - {num}, on_board | {num})
+        for num in on_board:
+            extend(sequence + [locations[num][1]], waiting, on_board - {num})
+
+    extend([], frozenset(range(len(locations))), frozenset())
+    return out
+
+
+def shared_sequences(locations: list,
+                     trip_lengths: list,
+                     skim: dict
+                     ) -> list:
+    """
+    Sequences serving the travellers together which save kilometres,
+    i.e. are shorter than the sum of their trips
+    @param locations: for each traveller [(node, 'o', traveller), (node, 'd', traveller)]
+    @param trip_lengths: requested trip lengths of the travellers
+    @param skim: skim dictionary
+    @return: list of (sequence, length) from the shortest
+    """
+    sequences = admissible_sequences(locations)
+    lengths = compute_distances_batch(
+        route_indices([[t[0] for t in sequence] for sequence in sequences], skim),
+        skim
+    )
+    out = [(sequence, length) for sequence, length in zip(sequences, lengths.tolist())
+           if length < sum(trip_lengths)]
+    return sorted(out, key=lambda x: x[1])
+
+
+def shareability_graph(locations: list,
+                       trip_lengths: list,
+                       skim: dict
+                       ) -> dict:
+    """
+    Pairs of requests which can be served together
+    @param locations: for each request [(node, 'o', traveller), (node, 'd', traveller)]
+    @param trip_lengths: requested trip lengths
+    @param skim: skim dictionary
+    @return: request -> set of requests it can share with
+    """
+    edges = {num: set() for num in range(len(locations))}
+    for i, j in combinations(range(len(locations)), 2):
+        if shared_sequences([locations[i], locations[j]], [trip_lengths[i], trip_lengths[j]], skim):
+            edges[i].add(j)
+            edges[j].add(i)
+    return edges
+
+
+def enumerate_trips(edges: dict,
+                    max_size: int,
+                    evaluate
+                    ) -> dict:
+    """
+    Groups of requests to be served by one vehicle, built size by size:
+    a group is considered only if all its members pairwise share
+    and all its subgroups smaller by one are feasible
+    @param edges: shareability graph
+    @param max_size: maximal number of requests in a group
+    @param evaluate: function of a group (sorted tuple) and the groups found so far
+     returning its details, None if the group is infeasible
+    @return: group -> details, groups of at least two requests
+    """
+    trips = {}
+    level = [(num,) for num in sorted(edges)]
+    for size in range(2, max_size + 1):
+        new_level = []
+        for trip in level:
+            for num in sorted(edges[trip[-1]]):
+                if num <= trip[-1] or not all(num in edges[member] for member in trip):
+                    continue
+                candidate = trip + (num,)
+                if size > 2 and not all(sub in trips for sub in combinations(candidate, size - 1)):
+                    continue
+                details = evaluate(candidate, trips)
+                if details is not None:
+                    trips[candidate] = details
+                    new_level.append(candidate)
+        if not new_level:
+            break
+        level = new_level
+    return trips
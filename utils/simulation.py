@@ -0,0 +1,514 @@
+""" Event-driven simulation of operators serving travel requests """
+import multiprocessing
+import traceback
+from datetime import datetime as dt
+from datetime import timedelta as td
+from itertools import count
+
+import utils.common as utc
+from utils import skim_tools
+from utils.profiling import Profiler
+from utils.event_queue import EventQueue
+from dispatchers.taxidispatcher import TaxiDispatcher
+from base_objects.traveller import Traveller
+from base_objects.vehicle import Vehicle
+from utils.move_vehicles import move_vehicle_ride
+
+
+class _OperatorSimulation:
+    """
+    Operators of the data bank with their vehicles, rides and events, advanced one event
+    at a time of the timeline of the whole simulation. Vehicles move at every event
+    of that timeline, also at events of operators simulated elsewhere
+    """
+
+    def __init__(
+            self,
+            data_bank: dict,
+            events: list,
+            last_event_time: dt,
+            skim_handle: dict or None = None
+    ):
+        """
+        @param data_bank: data and configs as returned by utc.initialise_data_simulation
+        @param events: (position, event) of initial events of the operators,
+         position in the chronologically sorted events of the whole simulation
+        @param last_event_time: time of the first event of the whole simulation
+        @param skim_handle: skim already shared by utils.skim_tools.share_skim,
+         for worker processes evaluating pool rides; shared by start_pool_workers if not given
+        """
+        self.data_bank = data_bank
+        self.last_event_time = last_event_time
+        self.skim_handle = skim_handle
+        self.shared_here = False
+
+        # Initialise Operators, sharing the legs of vehicle routes and the profiler
+        self.path_cache = skim_tools.PathCache(
+            max_nodes=data_bank["simulation_config"].get("path_cache_nodes", 1_000_000)
+        )
+        self.profiler = Profiler(enabled=data_bank["simulation_config"].get("profiling", False))
+        self.dispatchers = {}
+        for dispatcher_name in data_bank["simulation_config"]["taxi_operators"]:
+            self.dispatchers[dispatcher_name] = TaxiDispatcher(
+                dispatcher_id=dispatcher_name,
+                fares=data_bank["fare_config"]["fares"][dispatcher_name],
+                operating_costs=data_bank["fare_config"]['operating_costs'][dispatcher_name],
+                fleet=data_bank["vehicles"].loc[data_bank["vehicles"]['operator'] == dispatcher_name],
+                skim=data_bank["skim"],
+                path_cache=self.path_cache,
+                profiler=self.profiler
+            )
+        # Add here if there are different kinds of operators
+        # ...
+
+        # Prepare individual behavioural preferences
+        # should be consistent with id from requests
+        data_bank['behavioural_details'] = utc.homogeneous_behaviours(
+            initial_configuration=data_bank["behavioural_config"],
+            requests=data_bank["requests"]
+        )
+
+        # Initialise dictionary with travellers, and the event at which each was added
+        self.travellers = {}
+        self.traveller_order = {}
+
+        # Requests collected over refresh_density and assigned jointly
+        self.batch_dispatch = data_bank["simulation_config"].get("batch_dispatch", False)
+        self.batch_pooling = data_bank["simulation_config"].get("batch_pooling", False)
+
+        # Events pushed while processing the event number n come after all events
+        # of the simulation pushed before, whichever operators pushed them
+        self.events = EventQueue()
+        for position, event in events:
+            self.events.push(event, order=(-1, position))
+        self._event_number = -1
+        self._pushed = count()
+
+    def start_pool_workers(self) -> None:
+        """ Pool rides evaluated in worker processes attached to the shared skim """
+        pool_workers = self.data_bank["simulation_config"].get("pool_workers", 1)
+        if pool_workers <= 1:
+            return
+        if self.skim_handle is None:
+            self.skim_handle = skim_tools.share_skim(self.data_bank["skim"])
+            self.shared_here = True
+        for _Dispatcher in self.dispatchers.values():
+            _Dispatcher.start_pool_workers(self.skim_handle, pool_workers)
+
+    def close(self) -> None:
+        """ Shut down pool workers and release the skim shared for them """
+        for _Dispatcher in self.dispatchers.values():
+            _Dispatcher.shutdown_pool_workers()
+        if self.shared_here:
+            skim_tools.release_shared_skim(self.data_bank["skim"], unlink=True)
+            self.shared_here = False
+
+    def reply(self) -> tuple:
+        """
+        State reported to the run after each event
+        @return: (time, type, order) of the next event of the operators, None if there is none,
+         and then whether any of their rides is still active
+        """
+        if self.events:
+            return self.events.next_key(), None
+        return None, not all(not r.active for r in self._all_rides())
+
+    def step(
+            self,
+            event_number: int,
+            current_time: dt,
+            owner: bool
+    ) -> tuple:
+        """
+        Advance to the next event of the simulation
+        @param event_number: number of the event in the simulation
+        @param current_time: time of the event
+        @param owner: the event is the next one of these operators, processed here
+        @return: as reply
+        """
+        self._event_number = event_number
+        self._pushed = count()
+        time_between_events = utc.difference_times(current_time, self.last_event_time)
+
+        # If the time has passed from the last event
+        if time_between_events > 0:
+            for _Dispatcher in self.dispatchers.values():
+                for ride_type in _Dispatcher.rides.values():
+                    for ride in list(ride_type):
+                        move_vehicle_ride(
+                            vehicle=ride.serving_vehicle,
+                            ride=ride,
+                            move_time=time_between_events,
+                            skim=self.data_bank["skim"],
+                            logger=self.data_bank["logger"],
+                            dispatcher=_Dispatcher
+                        )
+                        if not ride.active:
+                            _Dispatcher.archive_ride(ride)
+
+        if owner:
+            self._process_event(self.events.pop(), current_time)
+
+        for _Dispatcher in self.dispatchers.values():
+            _Dispatcher.expire_vehicles(current_time)
+
+        return self.reply()
+
+    def results(self) -> dict:
+        """ Vehicles, rides, travellers and profiler, as returned by run_simulation """
+        all_vehicles = []
+        for _Dispatcher in self.dispatchers.values():
+            for _veh_type in _Dispatcher.fleet.keys():
+                all_vehicles += _Dispatcher.fleet[_veh_type]
+
+        utc.log_if_logger(self.data_bank["logger"], 20, f"Path cache {self.path_cache.stats()}")
+
+        return {
+            "vehicles": all_vehicles,
+            "rides": self._all_rides(),
+            "travellers": self.travellers,
+            "profiler": self.profiler
+        }
+
+    def _all_rides(self) -> list:
+        all_rides = []
+        for _Dispatcher in self.dispatchers.values():
+            all_rides += _Dispatcher.all_rides()
+        return all_rides
+
+    def _push(self, event: tuple) -> None:
+        self.events.push(event, order=(self._event_number, next(self._pushed)))
+
+    def _postpone_request(self, request_event, request_traveller):
+        """ Traveller not served waits till the next refresh or resigns """
+        simulation_config = self.data_bank["simulation_config"]
+        request_traveller.service_details.waiting_time += simulation_config['refresh_density']
+
+        if self.data_bank['behavioural_details'][request_traveller.traveller_id]["maximal_waiting"] \
+                < request_traveller.service_details.waiting_time:
+            request_traveller.service_details.resigned = True
+
+        self._push((
+            request_event[0] + td(seconds=simulation_config['refresh_density']),
+            request_event[1],
+            request_event[2]
+        ))
+
+    def _process_event(self, event: tuple, current_time: dt) -> None:
+        data_bank = self.data_bank
+        profiler = self.profiler
+
+        # If the event is a new vehicle
+        if event[1] == 'new_vehicle':
+            v = event[2]
+            _Dispatcher = self.dispatchers[event[2]['operator']]
+            _Dispatcher.add_vehicle(Vehicle(
+                vehicle_id=v['id'],
+                start_node=v['origin'],
+                start_time=utc.str_to_datetime(v['start_time']),
+                end_time=utc.str_to_datetime(v['end_time']),
+                capacity=v['capacity'],
+                vehicle_speed=v['speed']
+            ), v['type'])
+
+        if event[1] == 'request':
+            started = profiler.start()
+            traveller = Traveller(
+                request=tuple(event[2]),
+                behavioural_details=data_bank["behavioural_details"][event[2]['id']]
+            )
+            traveller.calculate_trip_length(data_bank["skim"])
+            self.travellers[event[2]['id']] = traveller
+            self.traveller_order.setdefault(event[2]['id'], self._event_number)
+            serving_Dispatcher = self.dispatchers[event[2]['operator']]
+
+            # Kind of service one shall be offered, the same in both modes
+            if event[2]['type'] != 'pool':
+                raise NotImplementedError("Only 'pool' viable here as for now")
+
+            if self.batch_dispatch:
+                if not serving_Dispatcher.pending_requests:
+                    self._push((
+                        current_time + td(seconds=data_bank["simulation_config"]['refresh_density']),
+                        'dispatch',
+                        event[2]['operator']
+                    ))
+                serving_Dispatcher.pending_requests.append((event, traveller))
+
+            else:
+                pool_potential, taxi_potential = serving_Dispatcher.pool_utility(
+                    request=event[2],
+                    traveller=traveller,
+                    skim=data_bank["skim"],
+                    logger=data_bank["logger"],
+                    max_candidates=data_bank["simulation_config"].get("pool_candidates", 1)
+                )
+
+                if pool_potential:
+                    serving_Dispatcher.assign_pool(
+                        possible_assignments=pool_potential,
+                        traveller=traveller,
+                        skim=data_bank["skim"]
+                    )
+
+                elif not pool_potential and taxi_potential is not None:
+                    serving_Dispatcher.assign_taxi(
+                        taxi_ride=taxi_potential["taxi_ride"],
+                        vehicle=taxi_potential["vehicle"],
+                        pickup_delay=taxi_potential['pickup_delay'],
+                        utility=taxi_potential["utility"],
+                        traveller=taxi_potential["traveller"],
+                        profitability=taxi_potential["profitability"],
+                        skim=data_bank["skim"],
+                        logger=data_bank["logger"]
+                    )
+
+                elif not pool_potential and taxi_potential is None:
+                    self._postpone_request(event, traveller)
+
+            profiler.stop("request", started)
+
+        # Assign requests collected since the previous dispatch
+        if event[1] == 'dispatch':
+            started = profiler.start()
+            _Dispatcher = self.dispatchers[event[2]]
+            pending, _Dispatcher.pending_requests = _Dispatcher.pending_requests, []
+            if self.batch_pooling:
+                pooled = _Dispatcher.batch_pool_assignment(
+                    requests=[request_event[2] for request_event, _ in pending],
+                    travellers=[request_traveller for _, request_traveller in pending],
+                    skim=data_bank["skim"],
+                    max_trip_size=data_bank["simulation_config"].get("max_trip_size", 3),
+                    vehicles_per_trip=data_bank["simulation_config"].get("vehicles_per_trip", 5),
+                    logger=data_bank["logger"]
+                )
+                pending = [request for request, is_pooled in zip(pending, pooled) if not is_pooled]
+            offers = _Dispatcher.batch_taxi_assignment(
+                requests=[request_event[2] for request_event, _ in pending],
+                travellers=[request_traveller for _, request_traveller in pending],
+                skim=data_bank["skim"],
+                logger=data_bank["logger"]
+            )
+            for (request_event, request_traveller), offer in zip(pending, offers):
+                if offer is None:
+                    self._postpone_request(request_event, request_traveller)
+                    continue
+                _Dispatcher.assign_taxi(
+                    taxi_ride=offer["taxi_ride"],
+                    vehicle=offer["vehicle"],
+                    pickup_delay=offer['pickup_delay'],
+                    utility=offer["utility"],
+                    traveller=offer["traveller"],
+                    profitability=offer["profitability"],
+                    skim=data_bank["skim"],
+                    logger=data_bank["logger"]
+                )
+            profiler.stop("dispatch", started)
+
+
+class _InProcess:
+    """ Operators simulated in this process, driven as those in worker processes """
+
+    def __init__(self, simulation: _OperatorSimulation):
+        self.simulation = simulation
+        self._reply = simulation.reply()
+
+    def send(self, *step) -> None:
+        self._reply = self.simulation.step(*step)
+
+    def receive(self) -> tuple:
+        return self._reply
+
+
+class _OperatorProcess:
+    """ Operators simulated in a worker process attached to the shared skim """
+
+    def __init__(
+            self,
+            data_bank: dict,
+            events: list,
+            last_event_time: dt,
+            skim_handle: dict
+    ):
+        self._connection, worker_connection = multiprocessing.Pipe()
+        self._process = multiprocessing.Process(
+            target=_serve_operators,
+            args=(worker_connection, data_bank, events, last_event_time, skim_handle)
+        )
+        self._process.start()
+        worker_connection.close()
+
+    def send(self, *step) -> None:
+        self._connection.send(("step", step))
+
+    def receive(self):
+        status, reply = self._connection.recv()
+        if status == "error":
+            raise RuntimeError(f"Simulation of operators failed in a worker process\n{reply}")
+        return reply
+
+    def results(self) -> tuple:
+        """ As _OperatorSimulation.results, with the traveller_order """
+        self._connection.send(("results", None))
+        return self.receive()
+
+    def close(self) -> None:
+        if self._process.is_alive():
+            try:
+                self._connection.send(("close", None))
+            except OSError:
+                pass
+            self._process.join(timeout=60)
+            if self._process.is_alive():
+                self._process.terminate()
+                self._process.join()
+        self._connection.close()
+
+
+def _serve_operators(connection, data_bank, events, last_event_time, skim_handle) -> None:
+    """ Worker process of _OperatorProcess, advancing its operators as instructed """
+    data_bank["skim"] = skim_tools.attach_skim(skim_handle)
+    simulation = None
+    try:
+        simulation = _OperatorSimulation(data_bank, events, last_event_time, skim_handle)
+        simulation.start_pool_workers()
+        connection.send(("ok", simulation.reply()))
+        while True:
+            command, args = connection.recv()
+            if command == "step":
+                connection.send(("ok", simulation.step(*args)))
+            elif command == "results":
+                connection.send(("ok", (simulation.results(), simulation.traveller_order)))
+            else:
+                break
+    except Exception:
+        connection.send(("error", traceback.format_exc()))
+    finally:
+        if simulation is not None:
+            simulation.close()
+        skim_tools.release_shared_skim(data_bank["skim"])
+        connection.close()
+
+
+def _run_events(
+        participants: list,
+        refresh_density: int
+) -> None:
+    """
+    Process the events of all participants in the order of a single event queue.
+    At each event every participant moves its vehicles, and the one whose event it is
+    processes it. When no events are left and some ride is active,
+    the simulation goes on with an event without type after refresh_density
+    @param participants: _InProcess or _OperatorProcess, each simulating some operators
+    @param refresh_density: seconds between events when there are no other
+    """
+    replies = [participant.receive() for participant in participants]
+    event_number = 0
+    # Do while there are events pending
+    while True:
+        heads = [(head, num) for num, (head, _) in enumerate(replies) if head is not None]
+        if heads:
+            (current_time, _, _), owner = min(heads)
+        elif any(active for _, active in replies):
+            current_time += td(seconds=refresh_density)
+            owner = None
+        else:
+            break
+
+        for num, participant in enumerate(participants):
+            participant.send(event_number, current_time, num == owner)
+        replies = [participant.receive() for participant in participants]
+        event_number += 1
+
+
+def run_simulation(
+        data_bank: dict,
+        skim_handle: dict or None = None
+) -> dict:
+    """
+    Simulate the operators of the simulation configuration serving the requests
+    @param data_bank: data and configs as returned by utc.initialise_data_simulation
+    @param skim_handle: skim already shared by utils.skim_tools.share_skim,
+     for worker processes evaluating pool rides; shared for the run if not given
+    @return: dictionary with vehicles, rides, travellers and profiler of the run
+    """
+    # Calculation is performed at each event point
+    events = utc.sort_events_chronologically(
+        requests=data_bank["requests"],
+        vehicles=data_bank["vehicles"]
+    )
+    simulation = _OperatorSimulation(data_bank, list(enumerate(events)), events[0][0], skim_handle)
+    # Workers and shared memory are released also when the simulation fails
+    try:
+        simulation.start_pool_workers()
+        _run_events([_InProcess(simulation)], data_bank["simulation_config"]['refresh_density'])
+    finally:
+        simulation.close()
+
+    return simulation.results()
+
+
+def run_operators_in_parallel(
+        data_bank: dict,
+        workers: int
+) -> dict:
+    """
+    Simulate the operators in worker processes against the skim in shared memory,
+    with the same results as run_simulation. Operators share no vehicles or rides,
+    but vehicles move at every event of the simulation: the workers advance
+    through the events of all operators together, one event at a time.
+    Faster when processing an event takes much longer than passing it between processes
+    @param data_bank: data and configs as returned by utc.initialise_data_simulation
+    @param workers: maximal number of processes, each simulating consecutive operators
+    @return: as run_simulation
+    """
+    simulation_config = data_bank["simulation_config"]
+    operators = simulation_config["taxi_operators"]
+    events = list(enumerate(utc.sort_events_chronologically(
+        requests=data_bank["requests"],
+        vehicles=data_bank["vehicles"]
+    )))
+    workers = min(workers, len(operators))
+    groups = [operators[num * len(operators) // workers:(num + 1) * len(operators) // workers]
+              for num in range(workers)]
+
+    skim_handle = skim_tools.share_skim(data_bank["skim"])
+    participants = []
+    try:
+        for group in groups:
+            participants.append(_OperatorProcess(
+                data_bank=dict(
+                    data_bank,
+                    simulation_config=dict(simulation_config, taxi_operators=group),
+                    requests=data_bank["requests"].loc[data_bank["requests"]['operator'].isin(group)],
+                    vehicles=data_bank["vehicles"].loc[data_bank["vehicles"]['operator'].isin(group)],
+                    skim=None
+                ),
+                events=[(position, event) for position, event in events if event[2]['operator'] in group],
+                last_event_time=events[0][1][0],
+                skim_handle=skim_handle
+            ))
+        _run_events(participants, simulation_config['refresh_density'])
+        results = [participant.results() for participant in participants]
+    finally:
+        for participant in participants:
+            participant.close()
+        skim_tools.release_shared_skim(data_bank["skim"], unlink=True)
+
+    # Travellers in the order they were added in a single process
+    merged = {
+        "vehicles": [],
+        "rides": [],
+        "travellers": {},
+        "profiler": Profiler(enabled=simulation_config.get("profiling", False))
+    }
+    traveller_order = {}
+    for result, order in results:
+        merged["vehicles"] += result["vehicles"]
+        merged["rides"] += result["rides"]
+        merged["travellers"].update(result["travellers"])
+        merged["profiler"].merge(result["profiler"])
+        traveller_order.update(order)
+    merged["travellers"] = dict(sorted(merged["travellers"].items(),
+                                       key=lambda item: traveller_order[item[0]]))
+    return merged
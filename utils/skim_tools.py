@@ -0,0 +1,715 @@
+""" Storage and alternative representations of the skim matrix """
+import os
+import json
+import time
+import shutil
+import logging
+from collections import OrderedDict
+from multiprocessing import shared_memory
+from concurrent.futures import ProcessPoolExecutor, as_completed
+
+import numpy as np
+import pandas as pd
+import networkx as nx
+
+
+def sidecar_path(
+        skim_path: str,
+        suffix: str
+) -> str:
+    """
+    Path of a file stored alongside the skim matrix
+    @param skim_path: path to the skim matrix (.npy)
+    @param suffix: name of the sidecar, e.g. 'nodes'
+    @return: path to the sidecar file
+    """
+    return os.path.splitext(skim_path)[0] + '.' + suffix + '.npy'
+
+
+def save_array(
+        path: str,
+        array: np.ndarray
+) -> None:
+    """ Write an array to .npy through a temporary file, so that readers never see partial data """
+    tmp_path = path + '.tmp'
+    with open(tmp_path, 'wb') as file:
+        np.save(file, array)
+    os.replace(tmp_path, path)
+
+
+def save_skim_npy(
+        skim_path: str,
+        distances: np.ndarray,
+        nodes: np.ndarray,
+        predecessors: np.ndarray or None = None
+) -> None:
+    """
+    Save the skim in the raw .npy format with a sidecar node index
+    @param skim_path: path to the skim matrix (.npy)
+    @param distances: dense matrix [origin, destination]
+    @param nodes: osmnx node ids in the order of matrix rows
+    @param predecessors: optional predecessor table [origin, node] of dense indices
+    """
+    save_array(sidecar_path(skim_path, 'nodes'), np.asarray(nodes, dtype=np.int64))
+    if predecessors is not None:
+        save_array(sidecar_path(skim_path, 'pred'), np.asarray(predecessors, dtype=np.int32))
+    save_array(skim_path, distances)
+
+
+def load_skim_npy(
+        skim_path: str
+) -> (np.ndarray, np.ndarray, np.ndarray or None):
+    """
+    Open the skim stored in the raw .npy format. The matrix is memory-mapped,
+    so opening is immediate and the page cache is shared between processes
+    @param skim_path: path to the skim matrix (.npy)
+    @return: read-only memory-mapped matrix, osmnx node ids,
+     memory-mapped predecessors [origin, node] (None if not stored)
+    """
+    nodes = np.load(sidecar_path(skim_path, 'nodes'))
+    distances = np.load(skim_path, mmap_mode='r')
+    assert distances.shape == (len(nodes), len(nodes)), "Skim matrix and node index mismatch"
+    try:
+        predecessors = np.load(sidecar_path(skim_path, 'pred'), mmap_mode='r')
+    except FileNotFoundError:
+        predecessors = None
+    return distances, nodes, predecessors
+
+
+def convert_parquet_to_npy(
+        parquet_path: str,
+        skim_path: str,
+        dtype: str = 'float64'
+) -> None:
+    """
+    Convert a skim matrix saved in the legacy parquet format
+    @param parquet_path: path to the parquet skim matrix
+    @param skim_path: path to the new skim matrix (.npy)
+    @param dtype: type of stored distances
+    """
+    distances, nodes = frame_to_array(pd.read_parquet(parquet_path), dtype)
+    save_skim_npy(skim_path, distances, nodes)
+
+
+def frame_to_array(
+        skim_frame: pd.DataFrame,
+        dtype: str = 'float64'
+) -> (np.ndarray, np.ndarray):
+    """
+    Turn the skim DataFrame (columns: origins, index: destinations)
+    into a dense array with rows as origins and columns as destinations
+    @param skim_frame: pd.DataFrame with the skim matrix
+    @param dtype: type of stored distances
+    @return: dense matrix, osmnx node ids in the order of rows
+    """
+    skim_frame.columns = [int(t) for t in skim_frame.columns]
+    skim_frame.index = [int(t) for t in skim_frame.index]
+    nodes = np.array(skim_frame.columns, dtype=np.int64)
+    skim_frame = skim_frame.reindex(index=nodes)
+    distances = np.array(skim_frame.to_numpy(dtype=dtype).T, order='C')
+    distances[np.isnan(distances)] = np.inf
+    return distances, nodes
+
+
+def single_source_rows(
+        city_graph: nx.Graph,
+        source: int,
+        node_index: dict,
+        dtype: str = 'float64'
+) -> (np.ndarray, np.ndarray):
+    """
+    Shortest path lengths and predecessors from a single source
+    @param city_graph: networkx graph with 'length' on edges
+    @param source: osmnx id of the source node
+    @param node_index: osmnx id -> dense index
+    @param dtype: type of stored distances
+    @return: row of distances, row of dense indices of predecessors (-1 if none)
+    """
+    predecessors, lengths = nx.dijkstra_predecessor_and_distance(city_graph, source, weight='length')
+    distances = np.full(len(node_index), np.inf, dtype=dtype)
+    distances[[node_index[t] for t in lengths]] = list(lengths.values())
+    previous = np.full(len(node_index), -1, dtype=np.int32)
+    reached = [t for t, pred in predecessors.items() if pred]
+    previous[[node_index[t] for t in reached]] = [node_index[predecessors[t][0]] for t in reached]
+    return distances, previous
+
+
+# Graph and node index of a precomputation worker process
+_WORKER_GRAPH = None
+_WORKER_INDEX = None
+
+
+def _initialise_precompute_worker(
+        city_graph: nx.Graph,
+        nodes: np.ndarray
+) -> None:
+    """ Store the graph in the worker process, so that it is sent only once """
+    global _WORKER_GRAPH, _WORKER_INDEX
+    _WORKER_GRAPH = city_graph
+    _WORKER_INDEX = {node: num for num, node in enumerate(nodes.tolist())}
+
+
+def _compute_block(
+        block_id: int,
+        sources: list,
+        block_path: str,
+        dtype: str
+) -> (int, int):
+    """
+    Compute a block of skim rows with predecessors and write it to disk
+    @param block_id: number of the block
+    @param sources: osmnx ids of source nodes in the block
+    @param block_path: where the block is written
+    @param dtype: type of stored distances
+    @return: block id, number of rows
+    """
+    rows = np.empty((len(sources), len(_WORKER_INDEX)), dtype=dtype)
+    previous = np.empty((len(sources), len(_WORKER_INDEX)), dtype=np.int32)
+    for num, source in enumerate(sources):
+        rows[num], previous[num] = single_source_rows(_WORKER_GRAPH, source, _WORKER_INDEX, dtype)
+    # Distances are written last, their presence marks a finished block
+    save_array(sidecar_path(block_path, 'pred'), previous)
+    save_array(block_path, rows)
+    return block_id, len(sources)
+
+
+def precompute_skim(
+        city_graph: nx.Graph,
+        skim_path: str,
+        logger: logging.Logger,
+        workers: int = 1,
+        block_size: int = 256,
+        dtype: str = 'float64',
+        keep_blocks: bool = False
+) -> (np.ndarray, np.ndarray, np.ndarray):
+    """
+    Compute the full skim matrix, together with the predecessor table,
+    in blocks of source nodes spread across a process pool. Finished blocks are written to disk as they come,
+    so an interrupted run resumes from the blocks already computed
+    @param city_graph: networkx graph with 'length' on edges
+    @param skim_path: path to the resulting skim matrix (.npy)
+    @param logger: for logging purposes
+    @param workers: number of worker processes, 1 computes in the current process
+    @param block_size: number of source nodes in a block
+    @param dtype: type of stored distances
+    @param keep_blocks: whether to keep the block files after assembling the matrix
+    @return: memory-mapped matrix [origin, destination], osmnx node ids in the order of rows,
+     memory-mapped predecessors
+    """
+    if not skim_path.endswith('.npy'):
+        raise ValueError(f"Precomputed skim is stored in the .npy format, not {skim_path}")
+    blocks_dir = os.path.splitext(skim_path)[0] + '_blocks'
+    os.makedirs(blocks_dir, exist_ok=True)
+
+    # The node order and the blocks have to be the same across resumed runs
+    nodes_path = os.path.join(blocks_dir, 'nodes.npy')
+    settings_path = os.path.join(blocks_dir, 'settings.json')
+    settings = {"block_size": block_size, "dtype": np.dtype(dtype).str}
+    if os.path.exists(nodes_path):
+        nodes = np.load(nodes_path)
+        if set(nodes.tolist()) != set(city_graph.nodes):
+            raise ValueError(f"Graph changed since the blocks in {blocks_dir} were computed: "
+                             f"remove the directory to compute them again")
+        try:
+            with open(settings_path, encoding='utf-8') as f:
+                saved = json.load(f)
+        except FileNotFoundError:
+            saved = None
+        if saved != settings:
+            raise ValueError(f"Blocks in {blocks_dir} were computed with {saved}, not {settings}: "
+                             f"resume with the same settings or remove the directory")
+    else:
+        nodes = np.array(list(city_graph.nodes), dtype=np.int64)
+        with open(settings_path, 'w', encoding='utf-8') as f:
+            json.dump(settings, f)
+        save_array(nodes_path, nodes)
+
+    blocks = {}
+    for block_id, start in enumerate(range(0, len(nodes), block_size)):
+        block_path = os.path.join(blocks_dir, f'block_{block_id:05d}.npy')
+        blocks[block_id] = (nodes[start:start + block_size].tolist(), block_path)
+    # A block is done once both files are written, predecessors first
+    pending = [block_id for block_id, (_, block_path) in blocks.items()
+               if not (os.path.exists(block_path) and os.path.exists(sidecar_path(block_path, 'pred')))]
+
+    rows_total = len(nodes)
+    rows_done = sum(len(blocks[block_id][0]) for block_id in blocks if block_id not in pending)
+    if rows_done:
+        logger.warning(f"Resuming skim precomputation: {rows_done}/{rows_total} rows already computed")
+
+    start_time = time.time()
+    rows_new = 0
+
+    def log_progress(rows: int) -> None:
+        nonlocal rows_done, rows_new
+        rows_done += rows
+        rows_new += rows
+        throughput = rows_new / max(time.time() - start_time, 1e-9)
+        eta = (rows_total - rows_done) / throughput if throughput else float('inf')
+        logger.warning(f"Skim rows {rows_done}/{rows_total} ({100 * rows_done / rows_total:.1f}%), "
+                       f"{throughput:.1f} rows/s, ETA {eta:.0f}s")
+
+    if workers == 1:
+        _initialise_precompute_worker(city_graph, nodes)
+        for block_id in pending:
+            log_progress(_compute_block(block_id, *blocks[block_id], dtype)[1])
+    elif pending:
+        with ProcessPoolExecutor(max_workers=workers,
+                                 initializer=_initialise_precompute_worker,
+                                 initargs=(city_graph, nodes)) as executor:
+            futures = [executor.submit(_compute_block, block_id, *blocks[block_id], dtype)
+                       for block_id in pending]
+            for future in as_completed(futures):
+                log_progress(future.result()[1])
+
+    # Assemble blocks into the memory-mapped matrices
+    pred_path = sidecar_path(skim_path, 'pred')
+    for path, matrix_dtype, suffix in ((pred_path, np.int32, 'pred'), (skim_path, dtype, None)):
+        matrix = np.lib.format.open_memmap(path + '.tmp', mode='w+', dtype=matrix_dtype,
+                                           shape=(rows_total, rows_total))
+        for block_id, (sources, block_path) in blocks.items():
+            start = block_id * block_size
+            matrix[start:start + len(sources)] = np.load(
+                block_path if suffix is None else sidecar_path(block_path, suffix)
+            )
+        matrix.flush()
+        del matrix
+        if path == skim_path:
+            save_array(sidecar_path(skim_path, 'nodes'), nodes)
+        os.replace(path + '.tmp', path)
+
+    if not keep_blocks:
+        shutil.rmtree(blocks_dir)
+    logger.warning(f"Skim matrix of {rows_total} nodes written to {skim_path}")
+
+    return load_skim_npy(skim_path)
+
+
+class DijkstraRowCache:
+    """
+    Skim computed on demand: shortest path lengths and predecessors from a source
+    node are calculated with a single-source Dijkstra and kept in a bounded LRU cache.
+    Indexed like the dense matrix, [origin, destination] with dense node indices
+    """
+
+    def __init__(self,
+                 city_graph: nx.Graph,
+                 nodes: np.ndarray,
+                 maxsize: int = 1024,
+                 dtype: str = 'float64'
+                 ):
+        """
+        @param city_graph: networkx graph with 'length' on edges
+        @param nodes: osmnx node ids, position in the array is the dense index
+        @param maxsize: maximal number of rows kept in memory
+        @param dtype: type of stored distances
+        """
+        self.city_graph = city_graph
+        self.nodes = nodes
+        self.node_index = {node: num for num, node in enumerate(nodes.tolist())}
+        self.maxsize = maxsize
+        self.dtype = np.dtype(dtype)
+        self.shape = (len(nodes), len(nodes))
+        self.rows = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+
+    def __repr__(self):
+        return f"DijkstraRowCache: {len(self.rows)}/{self.maxsize} rows, hit rate {self.hit_rate:.2%}"
+
+    def __getitem__(self, key):
+        if not isinstance(key, tuple):
+            return self.row(int(key))
+
+        origins, destinations = key
+        if np.ndim(origins) == 0 and np.ndim(destinations) == 0:
+            return self.row(int(origins))[destinations]
+
+        origins, destinations = np.broadcast_arrays(np.asarray(origins), np.asarray(destinations))
+        out = np.empty(origins.shape, dtype=self.dtype)
+        for source in np.unique(origins):
+            mask = origins == source
+            out[mask] = self.row(int(source))[destinations[mask]]
+        return out
+
+    @property
+    def hit_rate(self) -> float:
+        """ Share of row requests served from the cache """
+        requests = self.hits + self.misses
+        return self.hits / requests if requests else 0
+
+    def row(self, source: int) -> np.ndarray:
+        """
+        Distances from the source to all nodes
+        @param source: dense index of the source node
+        @return: row of the skim matrix
+        """
+        return self._rows(source)[0]
+
+    def predecessor_row(self, source: int) -> np.ndarray:
+        """
+        Predecessors on the shortest paths from the source
+        @param source: dense index of the source node
+        @return: dense indices of predecessors, -1 if none
+        """
+        return self._rows(source)[1]
+
+    def _rows(self, source: int) -> (np.ndarray, np.ndarray):
+        rows = self.rows.get(source)
+        if rows is not None:
+            self.hits += 1
+            self.rows.move_to_end(source)
+            return rows
+
+        self.misses += 1
+        rows = single_source_rows(self.city_graph, self.nodes[source], self.node_index, self.dtype)
+        for row in rows:
+            row.flags.writeable = False
+
+        self.rows[source] = rows
+        if len(self.rows) > self.maxsize:
+            self.rows.popitem(last=False)
+        return rows
+
+    def stats(self) -> dict:
+        """ Cache statistics """
+        return {"rows": len(self.rows), "maxsize": self.maxsize,
+                "hits": self.hits, "misses": self.misses, "hit_rate": self.hit_rate}
+
+
+class PathCache:
+    """
+    Shortest paths between pairs of nodes kept in a bounded LRU cache,
+    so that rerouting computes only the legs not seen before.
+    Bounded by the total number of nodes on the stored paths
+    """
+
+    def __init__(self,
+                 max_nodes: int = 1_000_000
+                 ):
+        """
+        @param max_nodes: maximal number of nodes on all stored paths
+        """
+        self.max_nodes = max_nodes
+        self.legs = OrderedDict()
+        self.nodes = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def __repr__(self):
+        return f"PathCache: {len(self.legs)} legs, {self.nodes}/{self.max_nodes} nodes, " \
+               f"hit rate {self.hit_rate:.2%}"
+
+    def __len__(self):
+        return len(self.legs)
+
+    @property
+    def hit_rate(self) -> float:
+        """ Share of leg requests served from the cache """
+        requests = self.hits + self.misses
+        return self.hits / requests if requests else 0
+
+    def get(self, origin: int, destination: int) -> tuple or None:
+        """
+        Stored path of the leg
+        @param origin: osmnx node id
+        @param destination: osmnx node id
+        @return: nodes after the origin up to the destination, None if not stored
+        """
+        leg = self.legs.get((origin, destination))
+        if leg is None:
+            self.misses += 1
+            return None
+        self.hits += 1
+        self.legs.move_to_end((origin, destination))
+        return leg
+
+    def put(self, origin: int, destination: int, leg: list or tuple) -> None:
+        """
+        Store the path of the leg, dropping the least recently used ones over the limit
+        @param origin: osmnx node id
+        @param destination: osmnx node id
+        @param leg: nodes after the origin up to the destination
+        """
+        if len(leg) > self.max_nodes or (origin, destination) in self.legs:
+            return
+        self.legs[(origin, destination)] = tuple(leg)
+        self.nodes += len(leg)
+        while self.nodes > self.max_nodes:
+            _, dropped = self.legs.popitem(last=False)
+            self.nodes -= len(dropped)
+            self.evictions += 1
+
+    def clear(self) -> None:
+        """ Drop all stored paths, e.g. when the network changes """
+        self.legs.clear()
+        self.nodes = 0
+
+    def stats(self) -> dict:
+        """ Cache statistics """
+        return {"legs": len(self.legs), "nodes": self.nodes, "max_nodes": self.max_nodes,
+                "hits": self.hits, "misses": self.misses, "evictions": self.evictions,
+                "hit_rate": self.hit_rate}
+
+
+class QuantizedSkim:
+    """
+    Skim matrix stored as integers (or float16) in units of a given resolution.
+    Indexed like the dense matrix, returns distances in metres
+    """
+
+    def __init__(self,
+                 values: np.ndarray,
+                 resolution: float
+                 ):
+        """
+        @param values: quantized matrix [origin, destination]
+        @param resolution: metres per unit of the stored values
+        """
+        self.values = values
+        self.resolution = resolution
+        self.shape = values.shape
+        # Unreachable pairs: maximal integer or inf for floats
+        self.sentinel = np.iinfo(values.dtype).max if values.dtype.kind == 'u' else None
+
+    def __repr__(self):
+        return f"QuantizedSkim: {self.values.dtype}, resolution {self.resolution}m"
+
+    def __getitem__(self, key):
+        values = self.values[key]
+        if np.ndim(values) == 0:
+            if values == self.sentinel:
+                return np.inf
+            return float(values) * self.resolution
+        out = values.astype(np.float64) * self.resolution
+        if self.sentinel is not None:
+            out[values == self.sentinel] = np.inf
+        return out
+
+
+def quantize_skim(
+        distances: np.ndarray,
+        dtype: str = 'uint32',
+        resolution: float = 0.1,
+        chunk_rows: int = 1024
+) -> QuantizedSkim:
+    """
+    Store the skim matrix in a compact type
+    @param distances: dense matrix [origin, destination] in metres
+    @param dtype: 'uint16', 'uint32' or 'float16'
+    @param resolution: metres per unit of the stored values
+    @param chunk_rows: number of rows converted at once
+    @return: QuantizedSkim
+    """
+    dtype = np.dtype(dtype)
+    assert dtype in (np.uint16, np.uint32, np.float16), "Quantization only to uint16, uint32 or float16"
+    limit = np.iinfo(dtype).max - 1 if dtype.kind == 'u' else np.finfo(dtype).max
+
+    values = np.empty(distances.shape, dtype=dtype)
+    for start in range(0, distances.shape[0], chunk_rows):
+        chunk = np.asarray(distances[start:start + chunk_rows], dtype=np.float64) / resolution
+        reachable = np.isfinite(chunk)
+        if chunk[reachable].max(initial=0) > limit:
+            raise ValueError(f"Distances exceed the range of {dtype} with resolution {resolution}m")
+        if dtype.kind == 'u':
+            chunk = np.rint(chunk)
+            chunk[~reachable] = limit + 1
+        values[start:start + chunk_rows] = chunk
+    return QuantizedSkim(values, resolution)
+
+
+def validate_quantization(
+        distances: np.ndarray,
+        quantized: QuantizedSkim,
+        max_error: float or None = None,
+        chunk_rows: int = 1024
+) -> dict:
+    """
+    Compare the quantized skim against the exact matrix
+    @param distances: exact dense matrix [origin, destination]
+    @param quantized: QuantizedSkim built from the matrix
+    @param max_error: allowed absolute error in metres, None for no check
+    @param chunk_rows: number of rows compared at once
+    @return: report with errors and memory footprint
+    """
+    max_abs_error = 0
+    max_rel_error = 0
+    sum_abs_error = 0
+    reachable_pairs = 0
+    unreachable_mismatch = 0
+    for start in range(0, distances.shape[0], chunk_rows):
+        exact = np.asarray(distances[start:start + chunk_rows], dtype=np.float64)
+        approximate = quantized[start:start + chunk_rows]
+        reachable = np.isfinite(exact)
+        unreachable_mismatch += int((np.isfinite(approximate) != reachable).sum())
+        error = np.abs(approximate[reachable] - exact[reachable])
+        if error.size:
+            max_abs_error = max(max_abs_error, float(error.max()))
+            nonzero = exact[reachable] > 0
+            max_rel_error = max(max_rel_error,
+                                float((error[nonzero] / exact[reachable][nonzero]).max(initial=0)))
+            sum_abs_error += float(error.sum())
+            reachable_pairs += error.size
+
+    report = {
+        "dtype": str(quantized.values.dtype),
+        "resolution": quantized.resolution,
+        "max_abs_error": max_abs_error,
+        "mean_abs_error": sum_abs_error / reachable_pairs if reachable_pairs else 0,
+        "max_rel_error": max_rel_error,
+        "unreachable_mismatch": unreachable_mismatch,
+        "exact_bytes": distances.nbytes,
+        "quantized_bytes": quantized.values.nbytes,
+        "compression": distances.nbytes / quantized.values.nbytes
+    }
+    if max_error is not None and (max_abs_error > max_error or unreachable_mismatch):
+        raise ValueError(f"Quantized skim exceeds the error bound of {max_error}m: {report}")
+    return report
+
+
+def load_quantized_skim(
+        distances: np.ndarray,
+        skim_path: str,
+        logger: logging.Logger,
+        dtype: str = 'uint32',
+        resolution: float = 0.1,
+        max_error: float or None = None
+) -> QuantizedSkim:
+    """
+    Read the quantized skim stored next to the .npy matrix or quantize
+    and validate the exact one (storing the result for .npy skims).
+    A stored one is used only if built from the same file of the exact matrix,
+    its error report is checked against max_error
+    @param distances: exact dense matrix [origin, destination]
+    @param skim_path: path to the exact skim matrix
+    @param logger: for logging purposes
+    @param dtype: 'uint16', 'uint32' or 'float16'
+    @param resolution: metres per unit of the stored values
+    @param max_error: allowed absolute error in metres, None for no check
+    @return: QuantizedSkim
+    """
+    quantized_path = sidecar_path(skim_path, f'{dtype}_{resolution}')
+    report_path = os.path.splitext(quantized_path)[0] + '.json'
+    source = None
+    if skim_path.endswith('.npy'):
+        status = os.stat(skim_path)
+        source = {"shape": list(distances.shape), "size": status.st_size, "mtime_ns": status.st_mtime_ns}
+        try:
+            with open(report_path, encoding='utf-8') as f:
+                stored = json.load(f)
+        except FileNotFoundError:
+            stored = None
+        if stored is not None and stored["source"] == source and os.path.exists(quantized_path):
+            report = stored["report"]
+            if max_error is not None and (report["max_abs_error"] > max_error
+                                          or report["unreachable_mismatch"]):
+                raise ValueError(f"Quantized skim exceeds the error bound of {max_error}m: {report}")
+            logger.warning(f"Successfully memory-mapped quantized skim matrix ({dtype})")
+            return QuantizedSkim(np.load(quantized_path, mmap_mode='r'), resolution)
+        if stored is not None or os.path.exists(quantized_path):
+            logger.warning(f"Quantized skim {quantized_path} outdated, quantizing again")
+
+    quantized = quantize_skim(distances, dtype, resolution)
+    report = validate_quantization(distances, quantized, max_error)
+    logger.warning(f"Skim quantized to {dtype} with resolution {resolution}m: "
+                   f"max error {report['max_abs_error']:.3f}m, "
+                   f"mean error {report['mean_abs_error']:.3f}m, "
+                   f"{report['compression']:.1f}x smaller")
+    if skim_path.endswith('.npy'):
+        save_array(quantized_path, quantized.values)
+        with open(report_path, 'w', encoding='utf-8') as f:
+            json.dump({"source": source, "report": report}, f)
+    return quantized
+
+
+def _shared_block(
+        name: str or None = None,
+        size: int = 0
+) -> shared_memory.SharedMemory:
+    """ Create (name=None) or attach to a shared memory block, without tracking it in attaching processes """
+    if name is None:
+        return shared_memory.SharedMemory(create=True, size=max(size, 1))
+    try:
+        return shared_memory.SharedMemory(name=name, track=False)
+    except TypeError:
+        return shared_memory.SharedMemory(name=name)
+
+
+def share_skim(skim: dict) -> dict:
+    """
+    Copy the skim into shared memory, so that worker processes
+    attach to it with attach_skim instead of loading their own copy.
+    Routing in workers relies on the predecessor table instead of the graph
+    @param skim: skim dictionary of the 'graph' type
+    @return: handle - small picklable description of the shared skim
+    """
+    if skim["type"] != "graph":
+        raise NotImplementedError("Only the full skim matrix can be shared")
+    if skim.get("predecessors") is None:
+        raise ValueError("Predecessor table required to share the skim, use the .npy skim format")
+
+    distances = skim["skim_matrix"]
+    arrays = {
+        "skim_matrix": distances.values if isinstance(distances, QuantizedSkim) else distances,
+        "predecessors": skim["predecessors"],
+        "nodes": skim["nodes"],
+        "coordinates": skim["coordinates"]
+    }
+
+    handle = {
+        "type": skim["type"],
+        "resolution": distances.resolution if isinstance(distances, QuantizedSkim) else None,
+        "arrays": {}
+    }
+    skim["shared_memory"] = []
+    for key, array in arrays.items():
+        block = _shared_block(size=array.nbytes)
+        shared = np.ndarray(array.shape, dtype=array.dtype, buffer=block.buf)
+        shared[...] = array
+        skim["shared_memory"].append(block)
+        handle["arrays"][key] = (block.name, array.shape, array.dtype.str)
+    return handle
+
+
+def attach_skim(handle: dict) -> dict:
+    """
+    Attach to the skim shared by share_skim, without copying data
+    @param handle: returned by share_skim
+    @return: skim dictionary
+    """
+    skim = {"type": handle["type"], "city_graph": None, "shared_memory": []}
+    for key, (name, shape, dtype) in handle["arrays"].items():
+        block = _shared_block(name)
+        array = np.ndarray(shape, dtype=np.dtype(dtype), buffer=block.buf)
+        array.flags.writeable = False
+        skim[key] = array
+        skim["shared_memory"].append(block)
+
+    if handle["resolution"] is not None:
+        skim["skim_matrix"] = QuantizedSkim(skim["skim_matrix"], handle["resolution"])
+    skim["node_index"] = {node: num for num, node in enumerate(skim["nodes"].tolist())}
+    return skim
+
+
+def release_shared_skim(
+        skim: dict,
+        unlink: bool = False
+) -> None:
+    """
+    Detach from the shared skim
+    @param skim: skim dictionary which was shared or attached
+    @param unlink: free the memory, only by the process which shared the skim
+    """
+    if skim.get("city_graph") is None:
+        # Attached skim: views on shared memory have to be dropped before closing
+        for key in ("skim_matrix", "predecessors", "nodes", "coordinates"):
+            skim.pop(key, None)
+    for block in skim.pop("shared_memory", []):
+        try:
+            block.close()
+        except BufferError:
+            # Arrays still referenced elsewhere, memory unmapped at exit
+            pass
+        if unlink:
+            block.unlink()
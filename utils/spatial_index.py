@@ -0,0 +1,138 @@
+""" Spatial index of vehicles over coordinates of city nodes """
+import heapq
+from itertools import count
+
+import numpy as np
+
+from base_objects.vehicle import Vehicle
+from utils.common import distance_lower_bound, EARTH_RADIUS
+
+
+class VehicleGridIndex:
+    """
+    Uniform grid of cells holding vehicles by their current node.
+    Updated incrementally, answers nearest-first, k-nearest and radius queries
+    in terms of the great-circle lower bound of the network distance
+    """
+
+    # Margin for the distortion of the planar projection within a city
+    PROJECTION_SLACK = 0.95
+
+    def __init__(self,
+                 skim: dict,
+                 cell_size: float = 500
+                 ):
+        """
+        @param skim: skim dictionary with node coordinates
+        @param cell_size: side of a grid cell in metres
+        """
+        self.skim = skim
+        self.cell_size = cell_size
+        self.reference_cos = np.cos(np.nanmean(skim["coordinates"][:, 0])) \
+            if np.isfinite(skim["coordinates"]).any() else 1
+        self.cells = {}
+        self.positions = {}
+
+    def __len__(self):
+        return len(self.positions)
+
+    def __contains__(self, vehicle: Vehicle):
+        return vehicle in self.positions
+
+    def cell(self, node: int) -> tuple or None:
+        """ Grid cell of the node, None if coordinates are unknown """
+        lat, lon = self.skim["coordinates"][self.skim["node_index"][node]]
+        if np.isnan(lat) or np.isnan(lon):
+            return None
+        return (int(EARTH_RADIUS * lon * self.reference_cos // self.cell_size),
+                int(EARTH_RADIUS * lat // self.cell_size))
+
+    def add(self, vehicle: Vehicle) -> None:
+        """ Insert the vehicle at its current position or move it there """
+        node = vehicle.path.current_position
+        if vehicle in self.positions:
+            if self.positions[vehicle][1] == node:
+                return
+            self.remove(vehicle)
+        cell = self.cell(node)
+        self.cells.setdefault(cell, {})[vehicle] = None
+        self.positions[vehicle] = (cell, node)
+
+    def remove(self, vehicle: Vehicle) -> None:
+        """ Drop the vehicle from the index, if present """
+        position = self.positions.pop(vehicle, None)
+        if position is None:
+            return
+        vehicles = self.cells[position[0]]
+        del vehicles[vehicle]
+        if not vehicles:
+            del self.cells[position[0]]
+
+    def iter_nearest(self, node: int):
+        """
+        Vehicles ordered by the lower bound of the distance from the node
+        @param node: city node
+        @return: generator of (lower bound in metres, vehicle)
+        """
+        centre = self.cell(node)
+        heap = []
+        tie_break = count()
+
+        def push(vehicles):
+            if not vehicles:
+                return
+            bounds = distance_lower_bound(node, [self.positions[veh][1] for veh in vehicles], self.skim)
+            for bound, veh in zip(bounds, vehicles):
+                heapq.heappush(heap, (bound, next(tie_break), veh))
+
+        # Vehicles at nodes without coordinates have a zero bound
+        push(list(self.cells.get(None, {})))
+        if centre is None:
+            push([veh for cell, vehicles in self.cells.items() if cell is not None for veh in vehicles])
+            while heap:
+                bound, _, veh = heapq.heappop(heap)
+                yield bound, veh
+            return
+
+        occupied = [cell for cell in self.cells if cell is not None]
+        max_ring = max((max(abs(cell[0] - centre[0]), abs(cell[1] - centre[1])) for cell in occupied),
+                       default=-1)
+        for ring in range(max_ring + 1):
+            push([veh for cell in self._ring(centre, ring) for veh in self.cells.get(cell, {})])
+            # Vehicles in further rings are at least that far
+            ring_bound = ring * self.cell_size * self.PROJECTION_SLACK
+            while heap and heap[0][0] <= ring_bound:
+                bound, _, veh = heapq.heappop(heap)
+                yield bound, veh
+
+        while heap:
+            bound, _, veh = heapq.heappop(heap)
+            yield bound, veh
+
+    def nearest(self, node: int, k: int) -> list:
+        """ k vehicles with the smallest lower bound of distance, as (bound, vehicle) """
+        out = []
+        for bound_vehicle in self.iter_nearest(node):
+            if len(out) == k:
+                break
+            out.append(bound_vehicle)
+        return out
+
+    def within(self, node: int, radius: float) -> list:
+        """ Vehicles whose lower bound of distance does not exceed the radius, as (bound, vehicle) """
+        out = []
+        for bound, veh in self.iter_nearest(node):
+            if bound > radius:
+                break
+            out.append((bound, veh))
+        return out
+
+    @staticmethod
+    def _ring(centre: tuple, ring: int) -> list:
+        """ Cells at the Chebyshev distance ring from the centre """
+        if ring == 0:
+            return [centre]
+        x, y = centre
+        cells = [(x + dx, y + dy) for dx in (-ring, ring) for dy in range(-ring, ring + 1)]
+        cells += [(x + dx, y + dy) for dy in (-ring, ring) for dx in range(-ring + 1, ring)]
+        return cells